@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for signing a notification body during fan-out.
+
+Compares signing the body once per subscriber (the naive way) with the Signer
+used by the hub, which signs once per distinct secret and optionally does so
+in parallel. Usage:
+
+    python benchmarks/signing.py [subscribers] [distinct secrets] [threads]
+
+"""
+import os
+import sys
+import time
+
+from flask_websub.hub.tasks import Signer, CHUNK_SIZE
+from flask_websub.utils import calculate_hmac, chunks
+
+BODY = os.urandom(1024 * 1024)  # 1 MiB
+
+
+def naive(config, secrets):
+    algo = config['SIGNATURE_ALGORITHM']
+    for secret in secrets:
+        algo + '=' + calculate_hmac(algo, secret, BODY)
+
+
+def with_signer(config, secrets):
+    with Signer(config, BODY) as signer:
+        for chunk in chunks(secrets, CHUNK_SIZE):
+            signer.prepare(chunk)
+            for secret in chunk:
+                signer(secret)
+
+
+def measure(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def main(subscribers=10000, distinct=10, threads=4):
+    secrets = ['secret%s' % (i % distinct) for i in range(subscribers)]
+    config = {'SIGNATURE_ALGORITHM': 'sha512'}
+    print('%s subscribers, %s distinct secrets, 1 MiB body' % (subscribers,
+                                                               distinct))
+    base = measure(naive, config, secrets)
+    print('naive:               %8.3fs' % base)
+    t = measure(with_signer, config, secrets)
+    print('signer:              %8.3fs (%.0fx)' % (t, base / t))
+    threaded = dict(config, SIGNATURE_THREADS=threads)
+    t = measure(with_signer, threaded, secrets)
+    print('signer (%s threads): %8.3fs (%.0fx)' % (threads, t, base / t))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -2,11 +2,26 @@ import functools
 import itertools
 
 from .blueprint import build_blueprint, A_DAY
-from .tasks import make_request_retrying, send_change_notification, \
-                   subscribe, unsubscribe
-from .storage import SQLite3HubStorage
+from .tasks import make_request_retrying, make_batch_request, \
+                   release_parked, send_change_notification, subscribe, \
+                   unsubscribe, verify_intents
+from .storage import SQLite3HubStorage, RedisHubStorage, CachedHubStorage, \
+                     ShardedHubStorage, migrate_subscriptions, \
+                     AbstractAsyncHubStorage, AsyncHubStorageAdapter, \
+                     SyncHubStorageAdapter, AsyncSQLite3HubStorage, \
+                     FileSystemBodyStore, CacheBodyStore
+from .engine import AsyncDeliveryEngine
+from .breaker import CircuitBreaker
+from .limits import HostRateLimiter
+from .verification import IntentBatcher
+from ..utils import supported_encodings
 
-__all__ = ('Hub', 'SQLite3HubStorage')
+__all__ = ('Hub', 'SQLite3HubStorage', 'RedisHubStorage', 'CachedHubStorage',
+           'ShardedHubStorage', 'migrate_subscriptions',
+           'AbstractAsyncHubStorage', 'AsyncHubStorageAdapter',
+           'SyncHubStorageAdapter', 'AsyncSQLite3HubStorage',
+           'FileSystemBodyStore', 'CacheBodyStore', 'AsyncDeliveryEngine',
+           'CircuitBreaker', 'HostRateLimiter', 'IntentBatcher')
 
 
 class Hub:
@@ -19,14 +34,100 @@ class Hub:
       Lowering it means trying more frequently, but also for a shorter time.
       Highering it means the reverse.
     - MAX_ATTEMPTS=10: The amount of attempts the retrying process makes.
+    - BATCH_SIZE=None: If set, notifications are distributed in batches of (at
+      most) this many callbacks, each of which is a single celery task
+      carrying a single copy of the body. Callbacks on the same host are
+      batched together where possible. Only failed deliveries are retried,
+      individually. By default, every callback gets its own task.
+    - DELIVERY_LANES=None: Celery options (like 'queue' and 'priority') for
+      the delivery tasks, per lane. A dict that can have the keys 'default'
+      (first attempts), 'bulk' (first attempts of large distributions) and
+      'retry' (all later attempts). For example, {'retry': {'queue':
+      'websub-retry'}, 'bulk': {'queue': 'websub-bulk'}} keeps retry storms
+      and large fan-outs from delaying other notifications, if you dedicate
+      workers to those queues (or use broker priorities).
+    - LARGE_FANOUT_THRESHOLD=1000: The amount of notifications of a single
+      distribution after which the rest goes into the 'bulk' lane.
+    - COALESCE_NOTIFICATIONS=False: If True, notifications that are waiting
+      to be (re)tried are dropped once a newer distribution of the same topic
+      starts, as that one sends the latest content to the same callbacks.
+    - BODY_SERIALIZER=None: The name of a binary-safe celery serializer
+      (e.g. 'msgpack' or 'pickle') to use for the delivery tasks. If set,
+      notification bodies are passed to those tasks as raw bytes instead of
+      being base64-encoded, and are never decoded again. Your celery workers
+      need to accept this content type (see the accept_content setting).
+    - MAX_CONTENT_SIZE=None: If set, the maximum size (in bytes) of the topic
+      content the hub fetches when send_change_notification is called without
+      content. Larger content is not distributed.
+    - SPOOL_SIZE=1024 * 1024: Fetched topic content larger than this is kept
+      in a temporary file instead of in memory. Combine with a body store to
+      keep memory usage bounded for arbitrarily large content.
+    - CONDITIONAL_FETCH=False: If True, the hub remembers the ETag and
+      Last-Modified headers of topic content it fetched and distributed, and
+      uses them to make the next fetch conditional. If the topic responds with
+      '304 Not Modified', nothing is distributed.
+    - DEDUPLICATE_CONTENT=False: If True, send_change_notification does not
+      distribute content that is byte-for-byte equal to the content it
+      distributed last for the same topic.
+    - DEBOUNCE_SECONDS=None: If set, send_change_notification waits this many
+      seconds before distributing. Any newer change notification for the same
+      topic in that period replaces the waiting one, so a burst of publishes
+      results in a single distribution of the latest content.
+    - DEBOUNCE_MAX_WAIT=4 * DEBOUNCE_SECONDS: The maximum amount of seconds
+      a burst of publishes is postponed in total. Topics that keep changing
+      are distributed at least this often.
     - PUBLISH_SUPPORTED=False: makes it possible to do a POST request to the
       hub endpoint with mode=publish. This is nice for testing, but as it does
       no input validation, you should not leave this enabled in production.
     - SIGNATURE_ALGORITHM='sha512': The algorithm to sign a content
       notification body with. Other possible values are sha1, sha256 and
       sha384.
+    - SIGNATURE_THREADS=None: If set, bodies of 64KiB and up are signed with
+      (distinct) subscriber secrets in parallel, using this amount of threads.
+    - COMPRESSION=None: If set, a list of content codings ('gzip', and 'zstd'
+      if zstandard is installed) in order of preference. Notifications are
+      compressed with them, but only for callbacks that said to accept them
+      in the Accept-Encoding header of their intent verification response (as
+      the subscriber of this package does). Every body is compressed at most
+      once per coding per distribution. Codings that are not supported (e.g.
+      'zstd' without zstandard) are left out.
+    - COMPRESSION_MIN_SIZE=1024: Smaller bodies are never compressed.
     - REQUEST_TIMEOUT=3: Specifies how long to wait before considering a
       request to have failed.
+    - POOL_CONNECTIONS=10, POOL_MAXSIZE=10, POOL_BLOCK=False: Outgoing requests
+      re-use keep-alive connections from a per-process pool. These values
+      determine respectively the amount of hosts to keep connections open to,
+      the amount of connections to keep open per host, and whether
+      POOL_MAXSIZE should be a hard limit.
+    - CIRCUIT_BREAKER_THRESHOLD=None: If set, stop sending notifications to a
+      callback host after this many failures in a row, as long as it is down.
+      Notifications for it are parked (per host) instead, and sent again as
+      soon as a probe succeeds. Being parked does not count as an attempt.
+      Requires the `cache` keyword argument (see below). See CircuitBreaker.
+    - CIRCUIT_BREAKER_TIMEOUT=60: How long a host is left alone before it is
+      probed again.
+    - CIRCUIT_BREAKER_PROBE_INTERVAL=10: Time between probes of a host that
+      is not known to be up again.
+    - HOST_RATE_LIMIT=None: If set, the initial amount of requests per second
+      the hub sends to a single callback host. The actual limit adapts to
+      the latency and errors of the host, between HOST_RATE_LIMIT_MIN=0.1 and
+      HOST_RATE_LIMIT_MAX=100. Requests taking longer than
+      HOST_TARGET_LATENCY=1.0 seconds count as a sign of overload. Applies to
+      notifications as well as intent verification. A request is postponed
+      (re-scheduled) if the limit would make it wait for longer than
+      REQUEST_TIMEOUT. Being postponed does not count as an attempt. See
+      HostRateLimiter.
+    - VERIFICATION_QUEUE=None: If set, the celery queue the intent
+      verification tasks are sent to. Dedicate workers to it, so a wave of
+      (re)subscriptions doesn't hold up content delivery (and vice versa).
+    - VERIFICATION_BATCH_SIZE=None: If set, subscription requests received by
+      the hub endpoint are gathered, and verified in batches of (at most) this
+      size by a single task. Its verified subscriptions are stored in bulk.
+      See IntentBatcher.
+    - VERIFICATION_BATCH_DELAY=0.5: How long to wait for a batch to fill up.
+    - VERIFICATION_THREADS=16, VERIFICATION_PER_HOST=2: The amount of intents
+      of a batch that are verified concurrently, in total and per callback
+      host.
     - HUB_MIN_LEASE_SECONDS: The minimal lease_seconds value the hub will
       accept
     - HUB_DEFAULT_LEASE_SECONDS: The lease_seconds value the hub will use if
@@ -37,19 +138,84 @@ class Hub:
     You can pass in a celery object too, or do that later using init_celery. It
     is required to do so before actually using the hub, though.
 
+    Finally, you can pass in a body store (an AbstractBodyStore instance, e.g.
+    FileSystemBodyStore) as the `body_store` keyword argument. If you do,
+    notification bodies are stored there once per distribution, and the
+    celery tasks only carry a reference to them instead of the whole body.
+
+    Similarly, the `engine` keyword argument accepts an AsyncDeliveryEngine.
+    If given, send_change_notification delivers all notifications itself
+    instead of scheduling a celery task per callback.
+
+    Some of the features above need state shared by all celery workers. It is
+    kept in the `cache` keyword argument, which should share the API of
+    cachelib.BaseCache (e.g. a cachelib.RedisCache). If not given, a
+    cachelib.SimpleCache is used, which only shares state within a process.
+    Parked notifications are kept there too, so the circuit breaker requires
+    a cache that never evicts entries by itself (e.g. a Redis server without
+    a maxmemory eviction policy).
+
+    The content codings callbacks accept (see COMPRESSION) are kept apart, in
+    the `callback_cache` keyword argument (with the same API), so the
+    potentially large amount of them can't push the state above out of an
+    evicting cache. If not given, a separate cachelib.SimpleCache is used.
+
     User-facing properties have doc strings. Other properties should be
     considered implementation details.
 
     """
     counter = itertools.count()
 
-    def __init__(self, storage, celery=None, **config):
+    def __init__(self, storage, celery=None, body_store=None, engine=None,
+                 cache=None, callback_cache=None, **config):
         self.validators = []
         self.storage = storage
+        self.body_store = body_store
+        self.engine = engine
+        self.cache = cache
+        self.callback_cache = callback_cache
         self.config = config
+        if config.get('COMPRESSION'):
+            config['COMPRESSION'] = [encoding
+                                     for encoding in config['COMPRESSION']
+                                     if encoding in supported_encodings()]
+
+        self.circuit_breaker = None
+        if config.get('CIRCUIT_BREAKER_THRESHOLD'):
+            if cache is None:
+                # the fallback cache evicts, which would lose notifications
+                raise ValueError("CIRCUIT_BREAKER_THRESHOLD requires the "
+                                 "cache keyword argument")
+            self.circuit_breaker = CircuitBreaker(
+                self.shared_cache(),
+                threshold=config['CIRCUIT_BREAKER_THRESHOLD'],
+                reset_timeout=config.get('CIRCUIT_BREAKER_TIMEOUT', 60),
+                probe_interval=config.get('CIRCUIT_BREAKER_PROBE_INTERVAL',
+                                          10))
+        self.rate_limiter = None
+        if config.get('HOST_RATE_LIMIT'):
+            self.rate_limiter = HostRateLimiter(
+                self.shared_cache(),
+                rate=config['HOST_RATE_LIMIT'],
+                min_rate=config.get('HOST_RATE_LIMIT_MIN', 0.1),
+                max_rate=config.get('HOST_RATE_LIMIT_MAX', 100.0),
+                target_latency=config.get('HOST_TARGET_LATENCY', 1.0))
         if celery:
             self.init_celery(celery)
 
+    def shared_cache(self):
+        if self.cache is None:
+            # only required for this fallback:
+            from cachelib import SimpleCache
+            self.cache = SimpleCache(default_timeout=0)
+        return self.cache
+
+    def shared_callback_cache(self):
+        if self.callback_cache is None:
+            from cachelib import SimpleCache
+            self.callback_cache = SimpleCache(default_timeout=0)
+        return self.callback_cache
+
     def endpoint_hook(self):
         """Override this method to hook into the endpoint handling. Anything
         this method returns will be forwarded to validation functions when
@@ -77,13 +243,30 @@ class Hub:
             return celery.task(**opts)(wrapper)
 
         # tasks for internal use:
-        self.subscribe = task_with_hub(subscribe)
-        self.unsubscribe = task_with_hub(unsubscribe)
+        verification_opts = {}
+        if self.config.get('VERIFICATION_QUEUE'):
+            verification_opts['queue'] = self.config['VERIFICATION_QUEUE']
+        self.subscribe = task_with_hub(subscribe, **verification_opts)
+        self.unsubscribe = task_with_hub(unsubscribe, **verification_opts)
+        self.verify_intents = task_with_hub(verify_intents,
+                                            **verification_opts)
+        self.intent_batcher = None
+        if self.config.get('VERIFICATION_BATCH_SIZE'):
+            self.intent_batcher = IntentBatcher(
+                self.verify_intents.delay,
+                batch_size=self.config['VERIFICATION_BATCH_SIZE'],
+                delay=self.config.get('VERIFICATION_BATCH_DELAY', 0.5))
 
+        delivery_opts = {}
+        if self.config.get('BODY_SERIALIZER'):
+            delivery_opts['serializer'] = self.config['BODY_SERIALIZER']
         max_attempts = self.config.get('MAX_ATTEMPTS', 10)
         make_req = task_with_hub(make_request_retrying, bind=True,
-                                 max_retries=max_attempts)
+                                 max_retries=max_attempts, **delivery_opts)
         self.make_request_retrying = make_req
+        self.make_batch_request = task_with_hub(make_batch_request,
+                                                **delivery_opts)
+        self.release_parked = task_with_hub(release_parked)
 
         # user facing tasks
 
@@ -93,7 +276,7 @@ class Hub:
         # wrapped by cleanup_expired_subscriptions
         @task_with_hub
         def cleanup(hub):
-            self.storage.cleanup_expired_subscriptions()
+            return self.storage.cleanup_expired_subscriptions()
         self.cleanup = cleanup
 
         # wrapped by schedule_cleanup
@@ -118,7 +301,8 @@ class Hub:
     @property
     def cleanup_expired_subscriptions(self):
         """Removes any expired subscriptions from the backing data store.
-        It takes no arguments, and is a celery task.
+        It takes no arguments, and is a celery task. Its result is the amount
+        of removed subscriptions, if the storage backend reports it.
 
         """
         return self.cleanup
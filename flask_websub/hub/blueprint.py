@@ -37,7 +37,10 @@ def build_blueprint(hub, url_prefix):
 
         publish_supported = current_app.config.get('PUBLISH_SUPPORTED', False)
         endpoint_hook_data = hub.endpoint_hook()
-        if mode == 'subscribe':
+        if mode in ['subscribe', 'unsubscribe'] and hub.intent_batcher:
+            hub.intent_batcher.add([mode, callback_url, topic_url,
+                                    lease_seconds, secret, endpoint_hook_data])
+        elif mode == 'subscribe':
             hub.subscribe.delay(callback_url, topic_url, lease_seconds, secret,
                                 endpoint_hook_data)
         elif mode == 'unsubscribe':
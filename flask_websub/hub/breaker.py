@@ -0,0 +1,141 @@
+import time
+
+from ..utils import A_DAY
+
+__all__ = ('CircuitBreaker',)
+
+
+class CircuitBreaker:
+    """Keeps track of callback hosts that fail to accept notifications. After
+    `threshold` failures in a row, the circuit for a host opens: for
+    `reset_timeout` seconds, no notifications are sent to it at all. After
+    that, the circuit is half-open: a single probe is allowed through every
+    `probe_interval` seconds. The first successful one closes the circuit
+    again, while a failing one re-opens it.
+
+    While a circuit is not closed, deliveries to its host can be parked. They
+    are held (for at most `park_timeout` seconds) until they are taken out
+    again using unpark, so they don't have to be re-queued over and over.
+
+    The state is stored in `cache`, which should share the API of
+    cachelib.BaseCache. Use a cache that is shared between celery workers
+    (e.g. a cachelib.RedisCache) to share the state between them. Parked
+    deliveries are only stored in the cache, so it should never evict entries
+    before they time out (unlike e.g. a cachelib.SimpleCache with its default
+    threshold).
+
+    """
+    def __init__(self, cache, threshold=5, reset_timeout=60,
+                 probe_interval=10, park_timeout=2 * A_DAY):
+        self.cache = cache
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.probe_interval = probe_interval
+        self.park_timeout = park_timeout
+
+    def keys(self, host):
+        return ('breaker-failures:' + host, 'breaker-open:' + host,
+                'breaker-probe:' + host)
+
+    def parking_keys(self, host):
+        # (amount of deliveries ever parked, amount taken out again)
+        return 'breaker-parked:' + host, 'breaker-unparked:' + host
+
+    def slot_key(self, host, index):
+        return 'breaker-slot:%s:%s' % (host, index)
+
+    def closed(self, host):
+        """Returns if the circuit of host is closed. Unlike allow, this never
+        uses up a probe.
+
+        """
+        return (self.cache.get(self.keys(host)[0]) or 0) < self.threshold
+
+    def allow(self, host):
+        """Returns if a request to host can be made right now. Note that in
+        the half-open state, this uses up the probe.
+
+        """
+        failures_key, open_key, probe_key = self.keys(host)
+        if self.cache.get(open_key):
+            return False
+        if (self.cache.get(failures_key) or 0) >= self.threshold:
+            return self.cache.add(probe_key, True,
+                                  timeout=self.probe_interval)
+        return True
+
+    def retry_after(self, host):
+        """The amount of seconds until the circuit of host (half-)closes."""
+
+        reopen_time = self.cache.get(self.keys(host)[1])
+        return max(reopen_time - time.time(), 0) if reopen_time else 0
+
+    def record_success(self, host):
+        failures_key, open_key, probe_key = self.keys(host)
+        if self.cache.get(failures_key):
+            self.cache.delete_many(failures_key, probe_key)
+
+    def record_failure(self, host):
+        failures_key, open_key, probe_key = self.keys(host)
+        if self.cache.inc(failures_key) >= self.threshold:
+            self.cache.set(open_key, time.time() + self.reset_timeout,
+                           timeout=self.reset_timeout)
+
+    def park(self, host, delivery):
+        """Holds delivery (any value the cache can store) until it is taken
+        out by unpark. Returns False if it could not be held, because unpark
+        was taking out the deliveries of host at the same time. The caller
+        should then take care of the delivery itself.
+
+        """
+        parked_key, unparked_key = self.parking_keys(host)
+        # every delivery gets its own slot, so concurrent parks never
+        # overwrite each other.
+        index = self.cache.inc(parked_key)
+        slot_key = self.slot_key(host, index)
+        self.cache.set(slot_key, delivery, timeout=self.park_timeout)
+        if (self.cache.get(unparked_key) or 0) >= index:
+            # unpark already claimed the slot, and might have missed it.
+            self.cache.delete(slot_key)
+            return False
+        return True
+
+    def unpark(self, host, limit):
+        """Takes out at most `limit` of the parked deliveries of host, oldest
+        first. Don't call this concurrently for the same host.
+
+        """
+        parked_key, unparked_key = self.parking_keys(host)
+        start = self.cache.get(unparked_key) or 0
+        end = min(self.cache.get(parked_key) or 0, start + limit)
+        if end <= start:
+            return []
+        # claim the slots before reading them, see park.
+        self.cache.set(unparked_key, end, timeout=0)
+        slot_keys = [self.slot_key(host, i) for i in range(start + 1, end + 1)]
+        deliveries = self.cache.get_many(*slot_keys)
+        self.cache.delete_many(*slot_keys)
+        return [delivery for delivery in deliveries if delivery is not None]
+
+    def claim_release(self, host, renew=False):
+        """Returns True if the caller should take care of releasing the
+        parked deliveries of host (using unpark), because nobody else does.
+        Whoever does should renew the claim every time it checks the circuit
+        again, and end it when no deliveries are left.
+
+        """
+        key = 'breaker-release:' + host
+        timeout = 10 * max(self.reset_timeout, self.probe_interval)
+        if renew:
+            return self.cache.set(key, True, timeout=timeout)
+        return self.cache.add(key, True, timeout=timeout)
+
+    def end_release(self, host):
+        self.cache.delete('breaker-release:' + host)
+
+    def parked(self, host):
+        """The amount of deliveries currently parked for host."""
+
+        parked_key, unparked_key = self.parking_keys(host)
+        return max((self.cache.get(parked_key) or 0) -
+                   (self.cache.get(unparked_key) or 0), 0)
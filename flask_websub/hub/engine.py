@@ -0,0 +1,162 @@
+import asyncio
+import time
+
+from ..utils import warn, logger
+from .tasks import retry_countdown, callback_host, superseded, \
+                   CIRCUIT_OPEN, SUPERSEDED, POSTPONED
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+__all__ = ('AsyncDeliveryEngine',)
+
+NO_AIOHTTP = "AsyncDeliveryEngine requires aiohttp (pip install aiohttp)"
+
+
+class AsyncDeliveryEngine:
+    """Delivers the notifications of a whole distribution from a single
+    process using asyncio, instead of using a celery task per callback. A slow
+    subscriber then no longer blocks a worker slot while it is waiting. The
+    constructor arguments are:
+
+    - max_concurrency=1000: the maximum amount of simultaneous requests.
+    - max_per_host=10: the maximum amount of simultaneous requests to a
+      single callback host.
+    - max_retry_concurrency=None: the maximum amount of simultaneous retries.
+      Defaults to a quarter of max_concurrency, so retries never hold up first
+      attempts.
+
+    Retrying uses the same jittered backoff as the celery tasks, as configured
+    by BACKOFF_BASE and MAX_ATTEMPTS. Notifications for a host whose circuit
+    is open wait until a notification to it succeeds (or the next probe is
+    due), without using up an attempt. Note that this means the send_change
+    task only finishes when every delivery succeeded or gave up. Requires
+    aiohttp.
+
+    """
+    def __init__(self, max_concurrency=1000, max_per_host=10,
+                 max_retry_concurrency=None):
+        if aiohttp is None:  # pragma: no cover
+            raise ImportError(NO_AIOHTTP)
+        self.max_concurrency = max_concurrency
+        self.max_per_host = max_per_host
+        if max_retry_concurrency is None:
+            max_retry_concurrency = max(max_concurrency // 4, 1)
+        self.max_retry_concurrency = max_retry_concurrency
+
+    def distribute(self, hub, topic_url, deliveries, distribution=None):
+        """Send every notification in deliveries, an iterable of
+        (callback_url, headers, body) tuples. distribution is the sequence
+        number used to detect superseded notifications, if any.
+
+        """
+        gone = asyncio.run(self.distribute_async(hub, topic_url, deliveries,
+                                                 distribution))
+        hub.storage.delete_many((topic_url, callback) for callback in gone)
+
+    async def distribute_async(self, hub, topic_url, deliveries,
+                               distribution):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency,
+                                         limit_per_host=self.max_per_host)
+        timeout = aiohttp.ClientTimeout(total=hub.config.get('REQUEST_TIMEOUT',
+                                                             3))
+        slots = asyncio.Semaphore(self.max_concurrency)
+        retry_slots = asyncio.Semaphore(self.max_retry_concurrency)
+        host_up = {}
+        gone = []
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout) as session:
+            tasks = set()
+            for callback_url, headers, body in deliveries:
+                # don't read more callbacks than can be handled
+                await slots.acquire()
+                task = asyncio.ensure_future(self.deliver_retrying(
+                    hub, session, slots, retry_slots, topic_url,
+                    callback_url, headers, body, distribution, host_up,
+                    gone))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        return gone
+
+    async def deliver_retrying(self, hub, session, slots, retry_slots,
+                               topic_url, callback_url, headers, body,
+                               distribution, host_up, gone):
+        # the first attempt uses the slot acquired by distribute_async.
+        status = await self.deliver(hub, session, callback_url, headers, body)
+        slots.release()
+
+        max_attempts = hub.config.get('MAX_ATTEMPTS', 10)
+        host = callback_host(callback_url)
+        retries = 0
+        while status is POSTPONED or (status is None and
+                                      retries < max_attempts):
+            if status is POSTPONED:
+                # not attempted, so this does not count as an attempt.
+                await self.wait_for_host(hub, host, host_up)
+            else:
+                await asyncio.sleep(retry_countdown(hub, callback_url,
+                                                    retries))
+                retries += 1
+            if superseded(hub, topic_url, distribution):
+                logger.info(SUPERSEDED, topic_url, callback_url)
+                return
+            async with retry_slots, slots:
+                status = await self.deliver(hub, session, callback_url,
+                                            headers, body)
+        if status is not None and status is not POSTPONED and \
+                host in host_up:
+            host_up.pop(host).set()  # wake up the parked notifications
+        if status == 410:  # 'Gone': send no further notifications
+            gone.append(callback_url)
+
+    async def wait_for_host(self, hub, host, host_up):
+        """Waits until a notification to host succeeds, or until the circuit
+        of host lets the next probe through.
+
+        """
+        breaker = hub.circuit_breaker
+        timeout = breaker.retry_after(host) or breaker.probe_interval
+        event = host_up.setdefault(host, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def deliver(self, hub, session, callback_url, headers, body):
+        """Returns the status code, None if the request should be retried,
+        or POSTPONED if it was not attempted because the host is down.
+
+        """
+        breaker, host = hub.circuit_breaker, callback_host(callback_url)
+        if breaker and not breaker.allow(host):
+            logger.info(CIRCUIT_OPEN, host)
+            return POSTPONED
+        limiter = hub.rate_limiter
+        if limiter:
+            delay = limiter.acquire(host)
+            while delay:
+                await asyncio.sleep(delay)
+                delay = limiter.acquire(host)
+
+        start, status = time.monotonic(), None
+        try:
+            async with session.post(callback_url, headers=headers,
+                                    data=body) as resp:
+                status = resp.status
+                assert 200 <= resp.status < 300 or resp.status == 410
+        except (aiohttp.ClientError, asyncio.TimeoutError,
+                AssertionError) as e:
+            warn("Notification failed", e)
+            if breaker:
+                breaker.record_failure(host)
+            return None
+        finally:
+            if limiter:
+                limiter.record(host, time.monotonic() - start,
+                               limiter.overloaded(status))
+        if breaker:
+            breaker.record_success(host)
+        return status
@@ -0,0 +1,97 @@
+import time
+
+__all__ = ('HostRateLimiter',)
+
+
+class HostRateLimiter:
+    """Limits the rate of requests to each callback host using a token bucket
+    per host. The rate adapts itself (AIMD-style): every successful, fast
+    request additively increases it by `increase` requests per second (up to
+    `max_rate`), while every request that fails, signals overload (429 or
+    5xx) or takes longer than `target_latency` seconds multiplies it by
+    `decrease` (down to `min_rate`). New hosts start at `rate`, and can
+    receive up to `burst` requests at once.
+
+    The state is stored in `cache`, which should share the API of
+    cachelib.BaseCache. Use a cache that is shared between celery workers
+    (e.g. a cachelib.RedisCache) to share the limits between them. Note that
+    updates are not atomic, so concurrent workers can slightly exceed a
+    limit.
+
+    """
+    def __init__(self, cache, rate=10.0, min_rate=0.1, max_rate=100.0,
+                 burst=10, target_latency=1.0, increase=0.1, decrease=0.5,
+                 timeout=60 * 60):
+        self.cache = cache
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease = decrease
+        self.timeout = timeout
+
+    def key(self, host):
+        return 'rate-limit:' + host
+
+    def state(self, host, now):
+        """Returns the current (tokens, rate) of host."""
+
+        try:
+            tokens, updated, rate = self.cache.get(self.key(host))
+        except TypeError:  # not in the cache (anymore)
+            return self.burst, self.rate
+        return min(self.burst, tokens + (now - updated) * rate), rate
+
+    def acquire(self, host):
+        """Take a token from the bucket of host. Returns 0 if that succeeded,
+        or the amount of seconds to wait until a token is available otherwise.
+
+        """
+        now = time.time()
+        tokens, rate = self.state(host, now)
+        if tokens < 1:
+            return (1 - tokens) / rate
+        self.cache.set(self.key(host), (tokens - 1, now, rate),
+                       timeout=self.timeout)
+        return 0
+
+    def delay(self, host):
+        """The amount of seconds until a token for host is available, without
+        taking it.
+
+        """
+        tokens, rate = self.state(host, time.time())
+        return max((1 - tokens) / rate, 0)
+
+    def wait(self, host, max_wait=60):
+        """Block until a token for host could be acquired (returns True), or
+        until it is clear that will take longer than max_wait seconds (returns
+        False).
+
+        """
+        deadline = time.monotonic() + max_wait
+        delay = self.acquire(host)
+        while delay:
+            if time.monotonic() + delay > deadline:
+                return False
+            time.sleep(delay)
+            delay = self.acquire(host)
+        return True
+
+    @staticmethod
+    def overloaded(status_code):
+        return status_code is None or status_code == 429 or status_code >= 500
+
+    def record(self, host, latency, overloaded):
+        """Adapt the rate of host to the result of a request."""
+
+        now = time.time()
+        tokens, rate = self.state(host, now)
+        if overloaded or latency > self.target_latency:
+            rate = max(self.min_rate, rate * self.decrease)
+        else:
+            rate = min(self.max_rate, rate + self.increase)
+        self.cache.set(self.key(host), (tokens, now, rate),
+                       timeout=self.timeout)
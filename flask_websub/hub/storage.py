@@ -1,8 +1,30 @@
 import abc
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
+import mmap
+import os
+import time
 
-from ..utils import SQLite3StorageMixin
+from ..utils import SQLite3StorageMixin, ExecutorAdapterMixin, \
+                    LoopAdapterMixin, LocalCache, body_digest, chunks, \
+                    uuid4, A_DAY
 
-__all__ = ('AbstractHubStorage', 'SQLite3HubStorage',)
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None
+
+NO_EXPORT = ("%s does not support exporting subscriptions (override "
+             "export_subscriptions)")
+
+__all__ = ('AbstractHubStorage', 'SQLite3HubStorage', 'RedisHubStorage',
+           'CachedHubStorage', 'ShardedHubStorage', 'migrate_subscriptions',
+           'AbstractAsyncHubStorage', 'AsyncHubStorageAdapter',
+           'SyncHubStorageAdapter', 'AsyncSQLite3HubStorage',
+           'AbstractBodyStore', 'FileSystemBodyStore', 'CacheBodyStore')
 
 
 class AbstractHubStorage(metaclass=abc.ABCMeta):
@@ -31,6 +53,78 @@ class AbstractHubStorage(metaclass=abc.ABCMeta):
 
         """
 
+    def set_many(self, items):
+        """Like __setitem__, but for an iterable of (key, value) tuples.
+        Override this method if your backend can store them more efficiently
+        than one by one.
+
+        """
+        for key, value in items:
+            self[key] = value
+
+    def delete_many(self, keys):
+        """Like __delitem__, but for an iterable of keys. Override this
+        method if your backend can remove them more efficiently than one by
+        one.
+
+        """
+        for key in keys:
+            del self[key]
+
+    def export_subscriptions(self):
+        """A generator function that should return tuples with the
+        following values for every (non-expired) subscription in storage:
+
+        - topic_url
+        - callback_url
+        - secret
+        - expiration_time (a unix timestamp)
+
+        Required by migrate_subscriptions (for the source storage) and by
+        ShardedHubStorage (for every shard). Other storages have no way to
+        find all subscriptions, so the default implementation raises a
+        NotImplementedError as soon as it is called.
+
+        """
+        raise NotImplementedError(NO_EXPORT % type(self).__name__)
+
+    def export_subscription_pages(self, page_size=1000):
+        """Like get_callback_pages, but for export_subscriptions. Override
+        this method if your backend keeps resources in use while iterating
+        over export_subscriptions.
+
+        """
+        return chunks(self.export_subscriptions(), page_size)
+
+    def import_subscriptions(self, subscriptions):
+        """Store every subscription in `subscriptions`, an iterable of tuples
+        as generated by export_subscriptions. The default implementation uses
+        set_many.
+
+        """
+        now = time.time()
+        self.set_many(((topic_url, callback_url), {
+            'lease_seconds': int(expiration_time - now),
+            'secret': secret,
+        }) for topic_url, callback_url, secret, expiration_time
+            in subscriptions if expiration_time > now)
+
+    def merge_subscriptions(self, subscriptions):
+        """Like import_subscriptions, but a subscription that is stored
+        already is only overwritten if the imported one expires later. That
+        way, (re)subscriptions that were stored in the meantime are kept.
+
+        The default implementation looks up the stored subscriptions of every
+        topic first. Override it if your backend can merge atomically.
+
+        """
+        for topic_url, group in group_by_topic(subscriptions):
+            stored = {callback_url: expiration_time
+                      for callback_url, _, expiration_time
+                      in self.get_subscriptions(topic_url)}
+            self.import_subscriptions(subscription for subscription in group
+                                      if is_newer(subscription, stored))
+
     @abc.abstractmethod
     def get_callbacks(self, topic_url):
         """A generator function that should return tuples with the following
@@ -43,10 +137,34 @@ class AbstractHubStorage(metaclass=abc.ABCMeta):
 
         """
 
+    def get_callback_pages(self, topic_url, page_size=1000):
+        """A generator function that should return lists of at most
+        page_size (callback_url, secret) tuples, together containing
+        everything get_callbacks would. Used when distributing content.
+
+        The default implementation splits up the result of get_callbacks. If
+        your backend keeps resources (like a connection or read transaction)
+        in use while iterating over get_callbacks, override this method to
+        fetch each page separately instead.
+
+        """
+        yield from chunks(self.get_callbacks(topic_url), page_size)
+
+    def get_subscriptions(self, topic_url):
+        """Like get_callbacks, but the tuples contain a third value: the
+        expiration time of the subscription (a unix timestamp). Override this
+        method if your backend knows it, the default implementation yields
+        None instead.
+
+        """
+        for callback_url, secret in self.get_callbacks(topic_url):
+            yield callback_url, secret, None
+
     def cleanup_expired_subscriptions(self):
         """If your storage backend enforces the expiration times, there's
         nothing more to do. If it does not do so by default, you should
-        override this method, and remove all expired entries.
+        override this method, and remove all expired entries. If known,
+        return the amount of removed entries.
 
         """
 
@@ -61,18 +179,50 @@ class SQLite3HubStorage(AbstractHubStorage, SQLite3StorageMixin):
         primary key (topic_url, callback_url)
     )
     """
+    INDEX_SETUP_SQL = ("""
+    create index if not exists hub_expiration_time on hub(expiration_time)
+    """,)
     DELITEM_SQL = "delete from hub where topic_url=? and callback_url=?"
     SETITEM_SQL = """
     insert or replace into hub(topic_url, callback_url, expiration_time,
                                secret)
     values (?, ?, strftime('%s', 'now') + ?, ?)
     """
-    GET_CALLBACKS_SQL = """
+    GET_CALLBACKS_PAGE_SQL = """
     select callback_url, secret from hub
+    where topic_url=? and callback_url > ?
+          and expiration_time > strftime('%s', 'now')
+    order by callback_url
+    limit ?
+    """
+    GET_SUBSCRIPTIONS_SQL = """
+    select callback_url, secret, expiration_time from hub
     where topic_url=? and expiration_time > strftime('%s', 'now')
     """
+    IMPORT_SQL = """
+    insert or replace into hub(topic_url, callback_url, secret,
+                               expiration_time)
+    values (?, ?, ?, ?)
+    """
+    MERGE_SQL = """
+    insert into hub(topic_url, callback_url, secret, expiration_time)
+    values (?, ?, ?, ?)
+    on conflict(topic_url, callback_url) do update
+    set secret=excluded.secret, expiration_time=excluded.expiration_time
+    where excluded.expiration_time > hub.expiration_time
+    """
+    EXPORT_PAGE_SQL = """
+    select topic_url, callback_url, secret, expiration_time from hub
+    where (topic_url, callback_url) > (?, ?)
+          and expiration_time > strftime('%s', 'now')
+    order by topic_url, callback_url
+    limit ?
+    """
     CLEANUP_EXPIRED_SUBSCRIPTIONS_SQL = """
-    delete from hub where expiration_time <= strftime('%s', 'now')
+    delete from hub where rowid in (
+        select rowid from hub where expiration_time <= strftime('%s', 'now')
+        limit ?
+    )
     """
 
     def __delitem__(self, key):
@@ -84,11 +234,794 @@ class SQLite3HubStorage(AbstractHubStorage, SQLite3StorageMixin):
             connection.execute(self.SETITEM_SQL, key + (value['lease_seconds'],
                                                         value['secret'],))
 
+    def set_many(self, items):
+        # a single transaction (and thus fsync) for all of them.
+        with self.connection() as connection:
+            connection.executemany(self.SETITEM_SQL, (
+                key + (value['lease_seconds'], value['secret'])
+                for key, value in items
+            ))
+
+    def delete_many(self, keys):
+        with self.connection() as connection:
+            connection.executemany(self.DELITEM_SQL, keys)
+
+    def export_subscriptions(self):
+        for page in self.export_subscription_pages():
+            yield from page
+
+    def export_subscription_pages(self, page_size=1000):
+        # keyset pagination, like get_callback_pages
+        after = ('', '')
+        while True:
+            with self.connection() as connection:
+                args = after + (page_size,)
+                page = connection.execute(self.EXPORT_PAGE_SQL,
+                                          args).fetchall()
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = (page[-1]['topic_url'], page[-1]['callback_url'])
+
+    def import_subscriptions(self, subscriptions):
+        with self.connection() as connection:
+            connection.executemany(self.IMPORT_SQL, subscriptions)
+
+    def merge_subscriptions(self, subscriptions):
+        with self.connection() as connection:
+            connection.executemany(self.MERGE_SQL, subscriptions)
+
     def get_callbacks(self, topic_url):
+        for page in self.get_callback_pages(topic_url):
+            yield from page
+
+    def get_callback_pages(self, topic_url, page_size=1000):
+        # keyset pagination: every page is a short query of its own, so no
+        # connection (or read snapshot) is kept open in between pages.
+        after = ''
+        while True:
+            with self.connection() as connection:
+                args = (topic_url, after, page_size)
+                page = connection.execute(self.GET_CALLBACKS_PAGE_SQL,
+                                          args).fetchall()
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            after = page[-1]['callback_url']
+
+    def get_subscriptions(self, topic_url):
         with self.connection() as connection:
-            cursor = connection.execute(self.GET_CALLBACKS_SQL, (topic_url,))
-            yield from iter(cursor)
+            args = (topic_url,)
+            yield from iter(connection.execute(self.GET_SUBSCRIPTIONS_SQL,
+                                               args))
+
+    def cleanup_expired_subscriptions(self, batch_size=1000):
+        """Removes expired subscriptions in transactions of at most
+        batch_size rows, so other writers only have to wait for a single
+        batch. Returns the amount of removed subscriptions.
+
+        """
+        removed = 0
+        while True:
+            with self.connection() as connection:
+                cursor = connection.execute(
+                    self.CLEANUP_EXPIRED_SUBSCRIPTIONS_SQL, (batch_size,))
+            removed += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                return removed
+            time.sleep(0)  # give other threads a chance to write
+
+
+class RedisHubStorage(AbstractHubStorage):
+    def __init__(self, client, prefix='websub:', batch_size=1000):
+        """Stores subscriptions in Redis (or anything speaking its protocol),
+        so they can be shared by celery workers on multiple machines. `client`
+        should be a redis.Redis instance. Per topic, the callbacks are kept in
+        a sorted set scored by expiration time, and their secrets in a hash.
+        A set of all topics is used for exporting and cleaning up.
+
+        Expired subscriptions are skipped using a range query, and removed by
+        cleanup_expired_subscriptions. Writes are sent in pipelines of at most
+        batch_size commands.
+
+        """
+        self.redis = client
+        self.prefix = prefix
+        self.batch_size = batch_size
+
+    def topics_key(self):
+        return self.prefix + 'topics'
+
+    def callbacks_key(self, topic_url):
+        return self.prefix + 'callbacks:' + topic_url
+
+    def secrets_key(self, topic_url):
+        return self.prefix + 'secrets:' + topic_url
+
+    def __delitem__(self, key):
+        self.delete_many([key])
+
+    def __setitem__(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        now = time.time()
+        self.import_subscriptions(
+            (topic_url, callback_url, value['secret'],
+             now + value['lease_seconds'])
+            for (topic_url, callback_url), value in items
+        )
+
+    def delete_many(self, keys):
+        for chunk in chunks(keys, self.batch_size):
+            pipeline = self.redis.pipeline()
+            for topic_url, callback_url in chunk:
+                pipeline.zrem(self.callbacks_key(topic_url), callback_url)
+                pipeline.hdel(self.secrets_key(topic_url), callback_url)
+            pipeline.execute()
+
+    def import_subscriptions(self, subscriptions):
+        for chunk in chunks(subscriptions, self.batch_size):
+            pipeline = self.redis.pipeline()
+            for subscription in chunk:
+                self.store(pipeline, *subscription)
+            pipeline.execute()
+
+    def store(self, pipeline, topic_url, callback_url, secret,
+              expiration_time):
+        pipeline.zadd(self.callbacks_key(topic_url),
+                      {callback_url: expiration_time})
+        if secret:
+            pipeline.hset(self.secrets_key(topic_url), callback_url, secret)
+        else:
+            pipeline.hdel(self.secrets_key(topic_url), callback_url)
+        pipeline.sadd(self.topics_key(), topic_url)
+
+    def merge_subscriptions(self, subscriptions):
+        for topic_url, group in group_by_topic(subscriptions):
+            for chunk in chunks(group, self.batch_size):
+                while True:
+                    try:
+                        self.merge_chunk(topic_url, chunk)
+                        break
+                    except redis.WatchError:
+                        continue  # the topic changed in the meantime
+
+    def merge_chunk(self, topic_url, chunk):
+        """Stores the subscriptions of topic_url in chunk that expire later
+        than the stored ones, in a transaction that fails if any of its
+        subscriptions changes in the meantime.
+
+        """
+        key = self.callbacks_key(topic_url)
+        with self.redis.pipeline() as pipeline:
+            pipeline.watch(key)
+            scores = pipeline.zmscore(key, [s[1] for s in chunk])
+            pipeline.multi()
+            for subscription, score in zip(chunk, scores):
+                if score is None or subscription[3] > score:
+                    self.store(pipeline, *subscription)
+            pipeline.execute()
+
+    def export_subscriptions(self):
+        for topic_url in self.redis.sscan_iter(self.topics_key()):
+            topic_url = decode(topic_url)
+            for callback_url, secret, expiration_time in \
+                    self.get_subscriptions(topic_url):
+                yield topic_url, callback_url, secret, expiration_time
+
+    def get_callbacks(self, topic_url):
+        for page in self.get_callback_pages(topic_url):
+            yield from page
+
+    def get_callback_pages(self, topic_url, page_size=1000):
+        for page in self.subscription_pages(topic_url, page_size):
+            yield [(callback_url, secret) for callback_url, secret, _ in page]
+
+    def get_subscriptions(self, topic_url):
+        for page in self.subscription_pages(topic_url, self.batch_size):
+            yield from page
+
+    def subscription_pages(self, topic_url, page_size):
+        # keyset pagination over (expiration time, callback url), the order of
+        # the sorted set. Callbacks sharing the expiration time of the last
+        # one are skipped by counting them.
+        key = self.callbacks_key(topic_url)
+        minimum, skip, last_score = '(%r' % time.time(), 0, None
+        while True:
+            page = self.redis.zrangebyscore(key, minimum, '+inf', start=skip,
+                                            num=page_size, withscores=True)
+            if not page:
+                return
+            callbacks = [decode(callback_url) for callback_url, _ in page]
+            secrets = self.redis.hmget(self.secrets_key(topic_url), callbacks)
+            yield [(callback_url, decode(secret), score)
+                   for callback_url, secret, (_, score)
+                   in zip(callbacks, secrets, page)]
+            if len(page) < page_size:
+                return
+            for _, score in page:
+                if score == last_score:
+                    skip += 1
+                else:
+                    last_score, skip = score, 1
+            minimum = last_score
 
     def cleanup_expired_subscriptions(self):
+        """Returns the amount of removed subscriptions."""
+
+        removed = 0
+        for topic_url in self.redis.sscan_iter(self.topics_key()):
+            removed += self.cleanup_topic(decode(topic_url))
+        return removed
+
+    def cleanup_topic(self, topic_url):
+        removed = 0
+        while True:
+            try:
+                count = self.remove_expired(topic_url)
+            except redis.WatchError:
+                continue  # the topic changed in the meantime, try again
+            removed += count
+            if count < self.batch_size:
+                return removed
+
+    def remove_expired(self, topic_url):
+        """Removes a batch of expired callbacks of topic_url, in a transaction
+        that fails if any of its subscriptions changes in the meantime. Once
+        no callbacks are left, the topic itself is forgotten as well.
+
+        """
+        key = self.callbacks_key(topic_url)
+        with self.redis.pipeline() as pipeline:
+            pipeline.watch(key)
+            expired = pipeline.zrangebyscore(key, '-inf', time.time(),
+                                             start=0, num=self.batch_size)
+            remaining = pipeline.zcard(key) - len(expired)
+            pipeline.multi()
+            if expired:
+                pipeline.zrem(key, *expired)
+                pipeline.hdel(self.secrets_key(topic_url), *expired)
+            if not remaining:
+                pipeline.srem(self.topics_key(), topic_url)
+            pipeline.execute()
+        return len(expired)
+
+
+def decode(value):
+    if isinstance(value, bytes):
+        return value.decode('UTF-8')
+    return value
+
+
+def group_by_topic(subscriptions):
+    groups = collections.defaultdict(list)
+    for subscription in subscriptions:
+        groups[subscription[0]].append(subscription)
+    return groups.items()
+
+
+def is_newer(subscription, stored):
+    """stored maps callback urls to their expiration time (or None, if
+    unknown).
+
+    """
+    callback_url, expiration_time = subscription[1], subscription[3]
+    if callback_url not in stored:
+        return True
+    return stored[callback_url] is not None and \
+        expiration_time > stored[callback_url]
+
+
+class CachedHubStorage(AbstractHubStorage):
+    def __init__(self, storage, versions=None, timeout=60, max_topics=1024):
+        """Keeps the callbacks of recently notified topics in memory, in front
+        of another AbstractHubStorage instance: `storage`. Cached callbacks
+        are used for at most `timeout` seconds, and never after one of them
+        expires. At most `max_topics` topics are cached.
+
+        Writes through this object invalidate the cache of the current
+        process. To also invalidate the caches of other processes (e.g. other
+        celery workers), pass in a cache that is shared between them as
+        `versions` (it should share the API of cachelib.BaseCache, e.g. a
+        cachelib.RedisCache). It is used to store a version number per
+        topic, which is checked before using a cached callback list.
+
+        """
+        self.storage = storage
+        self.topics = LocalCache(versions, 'hub-version:', timeout,
+                                 max_topics)
+
+    def __delitem__(self, key):
+        del self.storage[key]
+        self.invalidate(key[0])
+
+    def __setitem__(self, key, value):
+        self.storage[key] = value
+        self.invalidate(key[0])
+
+    def set_many(self, items):
+        topics = set()
+        self.storage.set_many(track_topics(items, topics, lambda i: i[0][0]))
+        for topic_url in topics:
+            self.invalidate(topic_url)
+
+    def delete_many(self, keys):
+        topics = set()
+        self.storage.delete_many(track_topics(keys, topics, lambda k: k[0]))
+        for topic_url in topics:
+            self.invalidate(topic_url)
+
+    def export_subscriptions(self):
+        return self.storage.export_subscriptions()
+
+    def export_subscription_pages(self, page_size=1000):
+        return self.storage.export_subscription_pages(page_size)
+
+    def import_subscriptions(self, subscriptions):
+        topics = set()
+        self.storage.import_subscriptions(track_topics(subscriptions, topics,
+                                                       lambda s: s[0]))
+        for topic_url in topics:
+            self.invalidate(topic_url)
+
+    def merge_subscriptions(self, subscriptions):
+        topics = set()
+        self.storage.merge_subscriptions(track_topics(subscriptions, topics,
+                                                      lambda s: s[0]))
+        for topic_url in topics:
+            self.invalidate(topic_url)
+
+    def invalidate(self, topic_url):
+        self.topics.invalidate(topic_url)
+
+    def get_callbacks(self, topic_url):
+        return iter(self.topics.get(topic_url,
+                                    lambda: self.fetch_callbacks(topic_url)))
+
+    def fetch_callbacks(self, topic_url):
+        callbacks, expiration_times = [], []
+        for callback_url, secret, expiration_time in \
+                self.storage.get_subscriptions(topic_url):
+            callbacks.append((callback_url, secret))
+            if expiration_time is not None:
+                expiration_times.append(expiration_time)
+        return callbacks, min(expiration_times, default=None)
+
+    def get_subscriptions(self, topic_url):
+        return self.storage.get_subscriptions(topic_url)
+
+    def cleanup_expired_subscriptions(self):
+        return self.storage.cleanup_expired_subscriptions()
+
+
+class ShardedHubStorage(AbstractHubStorage):
+    def __init__(self, shards):
+        """Spreads topics over multiple AbstractHubStorage instances (e.g.
+        SQLite3HubStorage files on different disks), so they don't all share
+        a single write lock. `shards` is a dict mapping a name to each
+        storage. The names determine which shard a topic is stored in
+        (using rendezvous hashing), so keep them stable.
+
+        Adding a shard only moves the topics that should be stored in it.
+        Call rebalance() after changing the shards to move them.
+
+        """
+        self.shards = shards
+
+    def shard_name(self, topic_url):
+        def weight(name):
+            data = (name + '\n' + topic_url).encode('UTF-8')
+            return hashlib.sha1(data).digest()
+        return max(self.shards, key=weight)
+
+    def shard(self, topic_url):
+        return self.shards[self.shard_name(topic_url)]
+
+    def __delitem__(self, key):
+        del self.shard(key[0])[key]
+
+    def __setitem__(self, key, value):
+        self.shard(key[0])[key] = value
+
+    def group(self, items, get_topic):
+        groups = collections.defaultdict(list)
+        for item in items:
+            groups[self.shard_name(get_topic(item))].append(item)
+        return groups.items()
+
+    def set_many(self, items):
+        for name, group in self.group(items, lambda i: i[0][0]):
+            self.shards[name].set_many(group)
+
+    def delete_many(self, keys):
+        for name, group in self.group(keys, lambda k: k[0]):
+            self.shards[name].delete_many(group)
+
+    def export_subscriptions(self):
+        # not a generator, so a shard not supporting it fails right away
+        return itertools.chain.from_iterable(
+            [storage.export_subscriptions()
+             for storage in self.shards.values()])
+
+    def import_subscriptions(self, subscriptions):
+        for name, group in self.group(subscriptions, lambda s: s[0]):
+            self.shards[name].import_subscriptions(group)
+
+    def merge_subscriptions(self, subscriptions):
+        for name, group in self.group(subscriptions, lambda s: s[0]):
+            self.shards[name].merge_subscriptions(group)
+
+    def get_callbacks(self, topic_url):
+        return self.shard(topic_url).get_callbacks(topic_url)
+
+    def get_callback_pages(self, topic_url, page_size=1000):
+        return self.shard(topic_url).get_callback_pages(topic_url, page_size)
+
+    def get_subscriptions(self, topic_url):
+        return self.shard(topic_url).get_subscriptions(topic_url)
+
+    def cleanup_expired_subscriptions(self):
+        """Cleans up all shards in parallel. Returns the total amount of
+        removed subscriptions, as far as the shards report it.
+
+        """
+        with concurrent.futures.ThreadPoolExecutor(len(self.shards)) as pool:
+            counts = list(pool.map(
+                lambda storage: storage.cleanup_expired_subscriptions(),
+                self.shards.values()))
+        return sum(count or 0 for count in counts)
+
+    def rebalance(self):
+        """Moves every subscription that is not stored in the shard it
+        belongs to, e.g. after adding a shard. Returns the amount of moved
+        subscriptions. The subscriptions to move are read into memory one
+        shard at a time.
+
+        Subscriptions written since the shards changed already went to the
+        right shard. They are only overwritten by the moved ones if those
+        expire later.
+
+        """
+        # fail before moving anything if a shard does not support exporting
+        exports = [(name, storage, storage.export_subscriptions())
+                   for name, storage in self.shards.items()]
+        moved = 0
+        for name, storage, subscriptions in exports:
+            misplaced = [subscription for subscription in subscriptions
+                         if self.shard_name(subscription[0]) != name]
+            # copy first, so subscriptions are never missing
+            self.merge_subscriptions(misplaced)
+            storage.delete_many((topic_url, callback_url)
+                                for topic_url, callback_url, *_ in misplaced)
+            moved += len(misplaced)
+        return moved
+
+
+def migrate_subscriptions(source, target):
+    """Copies every subscription in `source` to `target` (both
+    AbstractHubStorage instances), e.g. to move to another backend or shard
+    layout. Returns the amount of copied subscriptions. Source has to
+    implement export_subscriptions.
+
+    """
+    count = 0
+
+    def counted(subscriptions):
+        nonlocal count
+        for subscription in subscriptions:
+            count += 1
+            yield subscription
+    target.import_subscriptions(counted(source.export_subscriptions()))
+    return count
+
+
+def track_topics(items, topics, get_topic):
+    for item in items:
+        topics.add(get_topic(item))
+        yield item
+
+
+class AbstractAsyncHubStorage(metaclass=abc.ABCMeta):
+    """The asyncio counterpart of AbstractHubStorage. As item assignment
+    cannot be awaited, it has set() and delete() methods instead. The methods
+    returning iterators return asynchronous iterators instead.
+
+    Use AsyncHubStorageAdapter to use an AbstractHubStorage from asyncio
+    code, and SyncHubStorageAdapter for the reverse.
+
+    """
+    @abc.abstractmethod
+    async def delete(self, key):
+        """See AbstractHubStorage.__delitem__"""
+
+    @abc.abstractmethod
+    async def set(self, key, value):
+        """See AbstractHubStorage.__setitem__"""
+
+    async def set_many(self, items):
+        for key, value in items:
+            await self.set(key, value)
+
+    async def delete_many(self, keys):
+        for key in keys:
+            await self.delete(key)
+
+    def export_subscriptions(self):
+        """An asynchronous generator function, see
+        AbstractHubStorage.export_subscriptions.
+
+        """
+        raise NotImplementedError(NO_EXPORT % type(self).__name__)
+
+    async def import_subscriptions(self, subscriptions):
+        now = time.time()
+        await self.set_many(((topic_url, callback_url), {
+            'lease_seconds': int(expiration_time - now),
+            'secret': secret,
+        }) for topic_url, callback_url, secret, expiration_time
+            in subscriptions if expiration_time > now)
+
+    @abc.abstractmethod
+    def get_callbacks(self, topic_url):
+        """An asynchronous generator function, see
+        AbstractHubStorage.get_callbacks.
+
+        """
+
+    async def get_callback_pages(self, topic_url, page_size=1000):
+        page = []
+        async for callback in self.get_callbacks(topic_url):
+            page.append(callback)
+            if len(page) == page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    async def get_subscriptions(self, topic_url):
+        async for callback_url, secret in self.get_callbacks(topic_url):
+            yield callback_url, secret, None
+
+    async def cleanup_expired_subscriptions(self):
+        """See AbstractHubStorage.cleanup_expired_subscriptions"""
+
+
+class AsyncHubStorageAdapter(ExecutorAdapterMixin, AbstractAsyncHubStorage):
+    """Makes an AbstractHubStorage (`wrapped`) usable from asyncio code. Its
+    methods run in a pool of at most `max_workers` threads (or in `executor`,
+    if given), so they don't block the event loop. Callbacks are fetched a
+    page at a time, and so are exported subscriptions; get_subscriptions is
+    read completely in a single thread hop.
+
+    """
+    async def delete(self, key):
+        await self.run(self.wrapped.__delitem__, key)
+
+    async def set(self, key, value):
+        await self.run(self.wrapped.__setitem__, key, value)
+
+    async def set_many(self, items):
+        await self.run(self.wrapped.set_many, list(items))
+
+    async def delete_many(self, keys):
+        await self.run(self.wrapped.delete_many, list(keys))
+
+    def export_subscriptions(self):
+        return self.iterate_pages(self.wrapped.export_subscription_pages())
+
+    async def import_subscriptions(self, subscriptions):
+        await self.run(self.wrapped.import_subscriptions, list(subscriptions))
+
+    def get_callbacks(self, topic_url):
+        return self.iterate_pages(self.wrapped.get_callback_pages(topic_url))
+
+    def get_callback_pages(self, topic_url, page_size=1000):
+        return self.pages(self.wrapped.get_callback_pages(topic_url,
+                                                          page_size))
+
+    async def get_subscriptions(self, topic_url):
+        subscriptions = await self.run(
+            list, self.wrapped.get_subscriptions(topic_url))
+        for subscription in subscriptions:
+            yield subscription
+
+    async def cleanup_expired_subscriptions(self):
+        return await self.run(self.wrapped.cleanup_expired_subscriptions)
+
+
+class AsyncSQLite3HubStorage(AsyncHubStorageAdapter):
+    def __init__(self, path, max_workers=4, **kwargs):
+        """A SQLite3HubStorage for asyncio code. Queries run in a pool of at
+        most `max_workers` threads, each of which keeps its own connection
+        open. Other keyword arguments are passed on to SQLite3HubStorage.
+
+        """
+        kwargs.setdefault('persistent', True)
+        super().__init__(SQLite3HubStorage(path, **kwargs), max_workers)
+
+
+class SyncHubStorageAdapter(LoopAdapterMixin, AbstractHubStorage):
+    """Makes an AbstractAsyncHubStorage (`wrapped`) usable as an
+    AbstractHubStorage, by running its coroutines on an event loop in another
+    thread (`loop`, or a new one if not given). Don't use it from that loop's
+    own thread.
+
+    """
+    def __delitem__(self, key):
+        self.run(self.wrapped.delete(key))
+
+    def __setitem__(self, key, value):
+        self.run(self.wrapped.set(key, value))
+
+    def set_many(self, items):
+        self.run(self.wrapped.set_many(list(items)))
+
+    def delete_many(self, keys):
+        self.run(self.wrapped.delete_many(list(keys)))
+
+    def export_subscriptions(self):
+        return self.iterate(self.wrapped.export_subscriptions())
+
+    def import_subscriptions(self, subscriptions):
+        self.run(self.wrapped.import_subscriptions(list(subscriptions)))
+
+    def get_callbacks(self, topic_url):
+        return self.iterate(self.wrapped.get_callbacks(topic_url))
+
+    def get_callback_pages(self, topic_url, page_size=1000):
+        return self.iterate(self.wrapped.get_callback_pages(topic_url,
+                                                            page_size))
+
+    def get_subscriptions(self, topic_url):
+        return self.iterate(self.wrapped.get_subscriptions(topic_url))
+
+    def cleanup_expired_subscriptions(self):
+        return self.run(self.wrapped.cleanup_expired_subscriptions())
+
+
+class AbstractBodyStore(metaclass=abc.ABCMeta):
+    """A body store holds notification bodies while they are being delivered,
+    so celery tasks only have to carry a reference to them. That reference is
+    a string returned by add (e.g. the content hash of the body, see
+    flask_websub.utils.body_digest). Bodies are reference counted: as soon as
+    every delivery of a body has finished or given up, the body should be
+    removed.
+
+    Implementations should take into account that methods can be called from
+    different threads or even different processes.
+
+    """
+    @abc.abstractmethod
+    def add(self, body, references=1):
+        """Store body (bytes) if it is not stored already, add `references` to
+        its reference count, and return its reference.
+
+        """
+
+    @abc.abstractmethod
+    def acquire(self, body_ref, references=1):
+        """Add `references` to the reference count of an already stored
+        body.
+
+        """
+
+    @abc.abstractmethod
+    def release(self, body_ref, references=1):
+        """Subtract `references` from the reference count of a stored body.
+        When it drops to zero, remove the body.
+
+        """
+
+    @abc.abstractmethod
+    def __getitem__(self, body_ref):
+        """Return the body (a bytes-like object) for body_ref. Raise a
+        KeyError if it is not (or no longer) available.
+
+        """
+
+
+class FileSystemBodyStore(AbstractBodyStore, SQLite3StorageMixin):
+    TABLE_SETUP_SQL = """
+    create table if not exists bodies(
+        digest text primary key,
+        refs integer not null
+    )
+    """
+    ACQUIRE_SQL = """
+    insert into bodies(digest, refs) values (?, ?)
+    on conflict(digest) do update set refs=refs + excluded.refs
+    """
+    RELEASE_SQL = "update bodies set refs=refs - ? where digest=?"
+    GET_REFS_SQL = "select refs from bodies where digest=?"
+    DELETE_SQL = "delete from bodies where digest=?"
+
+    def __init__(self, directory):
+        """Stores bodies as files in `directory`, which should be accessible
+        to all celery workers. Bodies are read back using mmap, so they do not
+        need to be copied into memory.
+
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        super().__init__(os.path.join(directory, 'refs.sqlite3'))
+
+    def blob_path(self, digest):
+        return os.path.join(self.directory, digest.replace(':', '-'))
+
+    def add(self, body, references=1):
+        digest = body_digest(body)
+        path = self.blob_path(digest)
+        # the write lock held by the transaction prevents concurrent releases
+        # from removing the file while it is being (re-)added.
+        with self.connection() as connection:
+            connection.execute(self.ACQUIRE_SQL, (digest, references))
+            if not os.path.exists(path):
+                tmp_path = path + '.' + uuid4()
+                with open(tmp_path, 'wb') as f:
+                    f.write(body)
+                os.replace(tmp_path, path)
+        return digest
+
+    def acquire(self, digest, references=1):
+        with self.connection() as connection:
+            connection.execute(self.ACQUIRE_SQL, (digest, references))
+
+    def release(self, digest, references=1):
         with self.connection() as connection:
-            connection.execute(self.CLEANUP_EXPIRED_SUBSCRIPTIONS_SQL)
+            connection.execute(self.RELEASE_SQL, (references, digest))
+            row = connection.execute(self.GET_REFS_SQL, (digest,)).fetchone()
+            if row and row['refs'] <= 0:
+                connection.execute(self.DELETE_SQL, (digest,))
+                # (on Windows, this fails while the file is still mapped)
+                with contextlib.suppress(OSError):
+                    os.remove(self.blob_path(digest))
+
+    def __getitem__(self, digest):
+        try:
+            with open(self.blob_path(digest), 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return b''  # empty files cannot be mmap-ed
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                return memoryview(mapped)
+        except FileNotFoundError:
+            raise KeyError(digest)
+
+
+class CacheBodyStore(AbstractBodyStore):
+    def __init__(self, cache, timeout=2 * A_DAY):
+        """Cache should share the API of cachelib.BaseCache, and be shared by
+        all celery workers (e.g. a cachelib.RedisCache). Bodies (and their
+        reference counts) are kept for at most `timeout` seconds, even if not
+        every delivery has finished by then.
+
+        A cache cannot remove a body only if its reference count is still
+        zero in a single atomic step. So unlike FileSystemBodyStore, every
+        add stores a separate copy of the body, which is only referenced by
+        the caller of add. Releasing its last reference then never removes a
+        body another distribution still needs.
+
+        """
+        self.cache = cache
+        self.timeout = timeout
+
+    def add(self, body, references=1):
+        body_ref = body_digest(body) + ':' + uuid4()
+        self.cache.set('refs:' + body_ref, references, timeout=self.timeout)
+        self.cache.set('body:' + body_ref, bytes(body), timeout=self.timeout)
+        return body_ref
+
+    def acquire(self, body_ref, references=1):
+        self.cache.inc('refs:' + body_ref, references)
+
+    def release(self, body_ref, references=1):
+        if self.cache.dec('refs:' + body_ref, references) <= 0:
+            self.cache.delete_many('refs:' + body_ref, 'body:' + body_ref)
+
+    def __getitem__(self, body_ref):
+        body = self.cache.get('body:' + body_ref)
+        if body is None:
+            raise KeyError(body_ref)
+        return body
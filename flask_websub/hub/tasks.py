@@ -1,86 +1,725 @@
 import requests
 
 import base64
+import collections
+import concurrent.futures
+import hashlib
+import io
+import itertools
+import mmap
 import random
+import tempfile
+import threading
+import time
+import urllib.parse
 
-from ..utils import get_content, calculate_hmac, request_url, warn, uuid4
+from ..utils import get_content, calculate_hmac, request_url, warn, uuid4, \
+                    logger, body_digest, compress, parse_accept_encoding
 from ..errors import NotificationError
 
-__all__ = ('send_change_notification', 'make_request_retrying', 'subscribe',
-           'unsubscribe')
+__all__ = ('send_change_notification', 'make_request_retrying',
+           'make_batch_request', 'release_parked', 'subscribe', 'unsubscribe',
+           'verify_intents')
 
 INVALID_LINK = "The Link header should contain both 'self' and 'hub' urls"
 NO_UPDATED_CONTENT = "Cannot get latest content from topic URL"
+CONTENT_TOO_LARGE = "Topic content is too large (should be <= %s bytes)"
 INTENT_UNVERIFIED = "Cannot verify subscriber intent - %s: %s"
+CIRCUIT_OPEN = "Circuit open for %s, postponing notification"
+RELEASING_PARKED = "Circuit closed for %s, releasing parked notifications"
+RATE_LIMITED = "Rate limit reached for %s, postponing request"
+SUPERSEDED = "Dropping superseded notification of %s for %s"
+UNCHANGED = "Content of %s did not change, skipping distribution"
+# the amount of callbacks fetched from storage & processed at once (a page)
+CHUNK_SIZE = 1000
+PARALLEL_SIGNING_SIZE = 64 * 1024
+# headers describing the message body as received from the topic url
+BODY_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding'}
+READ_CHUNK_SIZE = 64 * 1024
+# returned by deliver when a notification was not even attempted
+POSTPONED = object()
 
 
 # standalone tasks
-def send_change_notification(hub, topic_url, updated_content=None):
+def send_change_notification(hub, topic_url, updated_content=None,
+                             debounce_token=None):
     """7. Content Distribution"""
 
-    if updated_content:
-        body = base64.b64decode(updated_content['content'])
+    if debounced(hub, topic_url, updated_content, debounce_token):
+        return
+
+    fetched = not updated_content
+    if fetched:
+        new_content = get_new_content(hub, topic_url)
+        if not new_content:
+            logger.info(UNCHANGED, topic_url)
+            return
+        body, headers, digest = new_content
+        b64_body = None  # only encoded when required
     else:
-        body, updated_content = get_new_content(hub.config, topic_url)
-    b64_body = updated_content['content']
+        body = base64.b64decode(updated_content['content'])
+        b64_body = updated_content['content']
+        headers, digest = updated_content['headers'], None
 
-    headers = updated_content['headers']
     link_header = headers.get('Link', '')
     if 'rel="hub"' not in link_header or 'rel="self"' not in link_header:
         raise NotificationError(INVALID_LINK)
 
-    for callback_url, secret in hub.storage.get_callbacks(topic_url):
-        schedule_request(hub, topic_url, callback_url, secret, body, b64_body,
-                         headers)
+    deduplicate = hub.config.get('DEDUPLICATE_CONTENT')
+    if deduplicate:
+        digest = digest or body_digest(body)
+        if hub.shared_cache().get('content:' + topic_url) == digest:
+            logger.info(UNCHANGED, topic_url)
+            return
+
+    distribute(hub, topic_url, body, b64_body, dict(headers))
+    if deduplicate:
+        hub.shared_cache().set('content:' + topic_url, digest, timeout=0)
+    if fetched and hub.config.get('CONDITIONAL_FETCH'):
+        # only now the content is distributed, it's safe to skip it next time
+        hub.shared_cache().set('validators:' + topic_url,
+                               conditional_headers(headers), timeout=0)
+
+
+def debounced(hub, topic_url, updated_content, debounce_token):
+    """Returns True if distribution should not happen (yet). In that case,
+    it is postponed, as long as no other publish comes in for the same topic.
+    A burst of publishes is postponed for at most DEBOUNCE_MAX_WAIT seconds
+    in total, so topics that change all the time are still distributed.
+
+    """
+    debounce_seconds = hub.config.get('DEBOUNCE_SECONDS')
+    if not debounce_seconds:
+        return False
+    max_wait = hub.config.get('DEBOUNCE_MAX_WAIT', 4 * debounce_seconds)
+    key = 'debounce:' + topic_url
+    pending = hub.shared_cache().get(key)
+    if debounce_token:
+        # only the task of the latest publish is allowed to continue. If the
+        # pending publish is unknown (e.g. expired while this task waited in
+        # the queue), nothing newer replaced it.
+        if pending and pending[0] != debounce_token:
+            return True
+        hub.shared_cache().delete(key)
+        return False
+
+    now = time.time()
+    started = pending[1] if pending else now
+    debounce_token = uuid4()
+    hub.shared_cache().set(key, (debounce_token, started),
+                           timeout=2 * max_wait)
+    countdown = max(min(debounce_seconds, started + max_wait - now), 0)
+    hub.send_change.apply_async((topic_url, updated_content),
+                                {'debounce_token': debounce_token},
+                                countdown=countdown)
+    return True
+
+
+def distribute(hub, topic_url, body, b64_body, headers):
+    distribution = start_distribution(hub, topic_url)
+    variants = BodyVariants(hub, body, b64_body, headers)
+    with Signer(hub.config, body) as signer:
+        chunks = encoded_chunks(hub, signed_chunks(hub, topic_url, signer),
+                                len(body))
+        if hub.engine:
+            hub.engine.distribute(hub, topic_url,
+                                  engine_deliveries(chunks, variants),
+                                  distribution)
+            return
+
+        # the distribution holds a reference to every body variant until
+        # everything has been scheduled.
+        try:
+            schedule_requests(hub, topic_url, laned_chunks(hub, chunks),
+                              variants, distribution)
+        finally:
+            variants.release()
+
+
+def engine_deliveries(chunks, variants):
+    for chunk in chunks:
+        for callback_url, signature, encoding in chunk:
+            body, headers = variants[encoding]
+            yield callback_url, with_signature(headers, signature), body
+
+
+def conditional_headers(headers):
+    result = {}
+    if headers.get('ETag'):
+        result['If-None-Match'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        result['If-Modified-Since'] = headers['Last-Modified']
+    return result
+
+
+def start_distribution(hub, topic_url):
+    """Returns the sequence number of a new distribution of topic_url, if
+    superseded notifications should be dropped.
 
+    """
+    if hub.config.get('COALESCE_NOTIFICATIONS'):
+        return hub.shared_cache().inc('distribution:' + topic_url)
 
-def get_new_content(config, topic_url):
+
+def superseded(hub, topic_url, distribution):
+    """A newer distribution of the same topic sends the latest content to
+    the same callbacks, which makes notifications of older distributions
+    useless.
+
+    """
+    if distribution is None:
+        return False
+    latest = hub.shared_cache().get('distribution:' + topic_url)
+    return latest is not None and latest > distribution
+
+
+def get_new_content(hub, topic_url):
+    """Returns None if the topic did not change since its content was last
+    distributed (as far as conditional requests can tell).
+
+    """
+    request_headers = None
+    if hub.config.get('CONDITIONAL_FETCH'):
+        request_headers = hub.shared_cache().get('validators:' + topic_url)
     try:
-        response = get_content(config, topic_url)
+        response = get_content(hub.config, topic_url, request_headers)
+        with response:
+            if response.status_code == 304:  # Not Modified
+                return None
+            body, digest = read_content(hub.config, response)
     except requests.exceptions.RequestException as e:
         raise NotificationError(NO_UPDATED_CONTENT) from e
+    return body, response.headers, digest
+
+
+def read_content(config, response):
+    """Reads the body of a streaming response, while calculating its digest.
+    Bodies larger than SPOOL_SIZE are spooled to a temporary file, and
+    returned as a memory map of that file, so they don't take up memory.
+
+    """
+    max_size = config.get('MAX_CONTENT_SIZE')
+    spool_size = config.get('SPOOL_SIZE', 1024 * 1024)
+    content_length = response.headers.get('Content-Length', '')
+    if max_size and content_length.isdigit() and \
+            int(content_length) > max_size:
+        raise NotificationError(CONTENT_TOO_LARGE % max_size)
+
+    hash, size, buffer = hashlib.sha256(), 0, io.BytesIO()
+    try:
+        for chunk in response.iter_content(READ_CHUNK_SIZE):
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise NotificationError(CONTENT_TOO_LARGE % max_size)
+            if isinstance(buffer, io.BytesIO) and size > spool_size:
+                spool = tempfile.TemporaryFile()
+                spool.write(buffer.getbuffer())
+                buffer = spool
+            hash.update(chunk)
+            buffer.write(chunk)
+
+        digest = 'sha256:' + hash.hexdigest()
+        if isinstance(buffer, io.BytesIO):
+            return buffer.getvalue(), digest
+        buffer.flush()
+        # the mapping stays valid after the file is closed
+        mapped = mmap.mmap(buffer.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped), digest
+    finally:
+        buffer.close()
+
+
+def store_body(hub, body, encoded_body=None):
+    """Returns the reference to the body that is passed to the delivery
+    tasks: either a digest (when there's a body store), the raw body (when
+    the delivery tasks use a binary-safe serializer), or the base64-encoded
+    body.
+
+    """
+    if hub.body_store:
+        return hub.body_store.add(body)
+    if hub.config.get('BODY_SERIALIZER'):
+        return bytes(body)
+    return encoded_body or base64.b64encode(body).decode('ascii')
+
+
+def load_body(hub, body_ref):
+    if hub.body_store:
+        return hub.body_store[body_ref]
+    if isinstance(body_ref, bytes):
+        return memoryview(body_ref)
+    return base64.b64decode(body_ref)
+
+
+def acquire_body(hub, body_ref, references):
+    if hub.body_store:
+        hub.body_store.acquire(body_ref, references)
+
+
+def release_body(hub, body_ref, references=1):
+    if hub.body_store and references:
+        hub.body_store.release(body_ref, references)
+
+
+def signed_chunks(hub, topic_url, signer):
+    """Yields lists of (callback_url, signature) tuples."""
+
+    for chunk in hub.storage.get_callback_pages(topic_url, CHUNK_SIZE):
+        signer.prepare(secret for callback_url, secret in chunk)
+        yield [(callback, signer(secret)) for callback, secret in chunk]
+
+
+def encoded_chunks(hub, chunks, body_size):
+    """Yields lists of (callback_url, signature, encoding) tuples. The
+    encoding is the preferred content coding (as configured by COMPRESSION)
+    the callback is known to accept, or None.
+
+    """
+    preferred = hub.config.get('COMPRESSION') or []
+    if body_size < hub.config.get('COMPRESSION_MIN_SIZE', 1024):
+        preferred = []
+    for chunk in chunks:
+        accepted = [None] * len(chunk)
+        if preferred:
+            keys = ['encodings:' + callback for callback, _ in chunk]
+            accepted = hub.shared_callback_cache().get_many(*keys)
+        yield [(callback, signature, choose_encoding(preferred, encodings))
+               for (callback, signature), encodings in zip(chunk, accepted)]
+
+
+def choose_encoding(preferred, accepted):
+    for encoding in preferred:
+        if encoding in (accepted or ()):
+            return encoding
+    return None
+
+
+def laned_chunks(hub, chunks):
+    """Yields lists of (callback_url, signature, encoding, lane) tuples.
+    Notifications beyond the first LARGE_FANOUT_THRESHOLD of a distribution
+    go to the 'bulk' lane, so small distributions don't have to wait for
+    large ones.
+
+    """
+    threshold = hub.config.get('LARGE_FANOUT_THRESHOLD', 1000)
+    scheduled = 0
+    for chunk in chunks:
+        laned_chunk = []
+        for callback_url, signature, encoding in chunk:
+            lane = 'default' if scheduled < threshold else 'bulk'
+            laned_chunk.append((callback_url, signature, encoding, lane))
+            scheduled += 1
+        yield laned_chunk
+
+
+def lane_options(hub, lane):
+    """The celery options (e.g. queue and/or priority) for the delivery
+    tasks of a lane, as configured by DELIVERY_LANES.
+
+    """
+    return dict((hub.config.get('DELIVERY_LANES') or {}).get(lane, {}))
+
+
+def remember_encodings(hub, callback_url, response, lease_seconds):
+    """Subscribers advertise the content codings they accept for
+    notifications using the Accept-Encoding header of their intent
+    verification response (RFC 7694).
+
+    """
+    if not hub.config.get('COMPRESSION'):
+        return
+    key = 'encodings:' + callback_url
+    accepted = parse_accept_encoding(response.headers.get('Accept-Encoding'))
+    if accepted:
+        hub.shared_callback_cache().set(key, sorted(accepted),
+                                        timeout=lease_seconds)
     else:
-        return response.content, {
-            'headers': response.headers,
-            'content': base64.b64encode(response.content).decode('ascii'),
-        }
+        hub.shared_callback_cache().delete(key)
 
 
-def schedule_request(hub, topic_url, callback_url, secret, body, encoded_body,
-                     headers):
-    specific_headers = dict(headers)
-    if secret:
-        # 7.1 Authenticated Content Distribution
-        #
+class BodyVariants:
+    """The body of a single distribution in every content coding that is
+    used to deliver it. Every variant is compressed, and stored, only once.
+    Indexing by encoding (None for the uncompressed body) returns a (body,
+    headers) tuple. The body is always signed uncompressed, as that is what
+    subscribers verify after decoding it.
+
+    """
+    def __init__(self, hub, body, b64_body, headers):
+        self.hub = hub
+        self.headers = {name: value for name, value in headers.items()
+                        if name.lower() not in BODY_HEADERS}
+        self.variants = {None: (body, self.headers)}
+        self.b64_body = b64_body
+        self.refs = {}
+
+    def __getitem__(self, encoding):
+        try:
+            return self.variants[encoding]
+        except KeyError:
+            body = compress(encoding, self.variants[None][0])
+            headers = dict(self.headers, **{'Content-Encoding': encoding})
+            variant = self.variants[encoding] = body, headers
+            return variant
+
+    def ref(self, encoding):
+        """Returns a (body_ref, headers) tuple. The distribution holds a
+        reference to the stored body until release is called.
+
+        """
+        try:
+            return self.refs[encoding]
+        except KeyError:
+            body, headers = self[encoding]
+            b64_body = self.b64_body if encoding is None else None
+            result = self.refs[encoding] = (store_body(self.hub, body,
+                                                       b64_body), headers)
+            return result
+
+    def release(self):
+        for body_ref, headers in self.refs.values():
+            release_body(self.hub, body_ref)
+
+
+def schedule_requests(hub, topic_url, chunks, variants, distribution):
+    batch_size = hub.config.get('BATCH_SIZE')
+    batches = collections.defaultdict(list)
+    for chunk in chunks:
+        if batch_size:
+            add_to_batches(hub, topic_url, batches, batch_size, chunk,
+                           variants, distribution)
+            continue
+        groups = collections.defaultdict(list)
+        for callback_url, signature, encoding, lane in chunk:
+            groups[encoding, lane].append((callback_url, signature))
+        for (encoding, lane), deliveries in groups.items():
+            body_ref, headers = variants.ref(encoding)
+            options = lane_options(hub, lane)
+            # body references need to be acquired before sending the tasks
+            # that release them. Doing so per chunk saves a lot of body store
+            # writes.
+            acquire_body(hub, body_ref, len(deliveries))
+            for callback_url, signature in deliveries:
+                args = (topic_url, callback_url,
+                        with_signature(headers, signature), body_ref,
+                        distribution)
+                hub.make_request_retrying.apply_async(args, **options)
+    for (encoding, lane), batch in batches.items():
+        if batch:
+            schedule_batch(hub, topic_url, batch, variants.ref(encoding),
+                           lane, distribution)
+
+
+def add_to_batches(hub, topic_url, batches, batch_size, deliveries, variants,
+                   distribution):
+    # every batch carries the body only once. Batches are filled up
+    # regardless of the callback host, as most hosts only have a few
+    # callbacks. Within a chunk, callbacks of the same host are kept
+    # together though, so a task can re-use its connection for them.
+    for callback_url, signature, encoding, lane in sorted(
+            deliveries, key=lambda delivery: callback_host(delivery[0])):
+        batch = batches[encoding, lane]
+        batch.append((callback_url, signature))
+        if len(batch) >= batch_size:
+            schedule_batch(hub, topic_url, batch, variants.ref(encoding),
+                           lane, distribution)
+            batches[encoding, lane] = []
+
+
+def schedule_batch(hub, topic_url, batch, variant, lane, distribution):
+    body_ref, headers = variant
+    acquire_body(hub, body_ref, len(batch))
+    hub.make_batch_request.apply_async(
+        (topic_url, batch, headers, body_ref, distribution),
+        **lane_options(hub, lane))
+
+
+class Signer:
+    """Calculates the X-Hub-Signature values for a single body (7.1
+    Authenticated Content Distribution). Subscribers often share a secret, so
+    every distinct secret is only signed with once. For large bodies, new
+    secrets are signed in parallel by SIGNATURE_THREADS threads (hashlib
+    releases the GIL while hashing).
+
+    """
+    def __init__(self, config, body):
         # Default to the strongest algorithm currently in the spec. Better
         # safe than sorry.
-        algo = hub.config.get('SIGNATURE_ALGORITHM', 'sha512')
-        hmac = calculate_hmac(algo, secret, body)
-        specific_headers['X-Hub-Signature'] = algo + '=' + hmac
-    hub.make_request_retrying.delay(topic_url, callback_url, specific_headers,
-                                    encoded_body)
+        self.algorithm = config.get('SIGNATURE_ALGORITHM', 'sha512')
+        self.body = body
+        self.signatures = {}
+        self.executor = None
+        threads = config.get('SIGNATURE_THREADS')
+        if threads and len(body) >= PARALLEL_SIGNING_SIZE:
+            self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.executor:
+            self.executor.shutdown()
+
+    def prepare(self, secrets):
+        """Sign with all (new) secrets at once. Optional, but faster."""
+
+        new_secrets = {s for s in secrets if s and s not in self.signatures}
+        if self.executor:
+            signatures = self.executor.map(self.calculate, new_secrets)
+        else:
+            signatures = map(self.calculate, new_secrets)
+        self.signatures.update(zip(new_secrets, signatures))
 
+    def calculate(self, secret):
+        return self.algorithm + '=' + calculate_hmac(self.algorithm, secret,
+                                                     self.body)
 
-# the next task is not meant to be user-facing
-def make_request_retrying(hub, self, topic_url, callback, headers, b64_body):
+    def __call__(self, secret):
+        if not secret:
+            return None
+        try:
+            return self.signatures[secret]
+        except KeyError:
+            signature = self.signatures[secret] = self.calculate(secret)
+            return signature
+
+
+def with_signature(headers, signature):
+    specific_headers = dict(headers)
+    if signature:
+        specific_headers['X-Hub-Signature'] = signature
+    return specific_headers
+
+
+def callback_host(callback_url):
+    return urllib.parse.urlsplit(callback_url).netloc
+
+
+def backoff(hub, retries):
     # retry for about an hour by default (enter in the formula & divide by 2
     # due to jitter)
     # https://www.awsarchitectureblog.com/2015/03/backoff.html
     # See also hub/__init__.py for the amount of retry attempts
     backoff_base = hub.config.get('BACKOFF_BASE', 8.0)
+    return random.uniform(0, backoff_base * 2 ** retries)
+
+
+def retry_countdown(hub, callback, retries):
+    countdown = backoff(hub, retries)
+    if hub.circuit_breaker:
+        # no use in retrying before the circuit closes.
+        host = callback_host(callback)
+        countdown = max(countdown, hub.circuit_breaker.retry_after(host))
+    return countdown
+
+
+def park(hub, delivery, retries):
+    """Holds a notification (a tuple of make_request_retrying arguments)
+    while the circuit of its callback host is not closed. It is sent again
+    (as retry number `retries`) by release_parked. Returns False if the
+    notification is not held.
+
+    """
+    breaker, host = hub.circuit_breaker, callback_host(delivery[1])
+    if not breaker or breaker.closed(host):
+        return False
+    if not breaker.park(host, tuple(delivery) + (retries,)):
+        return False
+    if breaker.claim_release(host):
+        hub.release_parked.apply_async((host,),
+                                       countdown=breaker.retry_after(host))
+    return True
+
+
+def postponed_countdown(hub, callback):
+    """The countdown for a request that was postponed without being
+    attempted. It does not back off, but does wait for the circuit and rate
+    limit of the callback host.
+
+    """
+    countdown = retry_countdown(hub, callback, 0)
+    if hub.rate_limiter:
+        countdown = max(countdown,
+                        hub.rate_limiter.delay(callback_host(callback)))
+    return countdown
+
+
+def retry_later(hub, delivery, retries, countdown):
+    """Schedules a notification (a tuple of make_request_retrying arguments)
+    as retry number `retries`, or parks it if its callback host is down.
+
+    """
+    if not park(hub, delivery, retries):
+        hub.make_request_retrying.apply_async(delivery, countdown=countdown,
+                                              retries=retries,
+                                              **lane_options(hub, 'retry'))
+
 
-    body = base64.b64decode(b64_body)
+# the next tasks are not meant to be user-facing
+def make_request_retrying(hub, self, topic_url, callback, headers, body_ref,
+                          distribution=None):
+    if superseded(hub, topic_url, distribution):
+        logger.info(SUPERSEDED, topic_url, callback)
+        release_body(hub, body_ref)
+        return
+
+    retries = self.request.retries
+    delivery = (topic_url, callback, headers, body_ref, distribution)
+    body = load_body(hub, body_ref)
+    status = deliver(hub, callback, headers, body)
+    if status is POSTPONED:
+        # not attempted, so this does not count as an attempt.
+        retry_later(hub, delivery, retries, postponed_countdown(hub, callback))
+    elif status:
+        if status == 410:  # 'Gone': send no further notifications
+            del hub.storage[topic_url, callback]
+        release_body(hub, body_ref)
+    else:
+        if retries >= self.max_retries:
+            release_body(hub, body_ref)  # giving up
+        elif park(hub, delivery, retries + 1):
+            return
+        countdown = retry_countdown(hub, callback, retries)
+        self.retry(countdown=countdown, **lane_options(hub, 'retry'))
+
+
+def make_batch_request(hub, topic_url, batch, headers, body_ref,
+                       distribution=None):
+    if superseded(hub, topic_url, distribution):
+        logger.info(SUPERSEDED, topic_url, 'a batch of callbacks')
+        release_body(hub, body_ref, len(batch))
+        return
+
+    body = load_body(hub, body_ref)
+    retried = 0
+    gone = []
     try:
-        resp = request_url(hub.config, 'POST', callback, headers=headers,
-                           data=body)
+        for callback, signature in batch:
+            specific_headers = with_signature(headers, signature)
+            status = deliver(hub, callback, specific_headers, body)
+            if status == 410:
+                gone.append((topic_url, callback))
+            elif status is POSTPONED or not status:
+                # only failed (or postponed) deliveries are retried -
+                # individually, or parked together with the other
+                # notifications for their host if it is down. A failed
+                # attempt counts as the first one. The retry takes over the
+                # body reference.
+                delivery = (topic_url, callback, specific_headers, body_ref,
+                            distribution)
+                if status is POSTPONED:
+                    retry_later(hub, delivery, 0,
+                                postponed_countdown(hub, callback))
+                else:
+                    retry_later(hub, delivery, 1,
+                                retry_countdown(hub, callback, 0))
+                retried += 1
+    finally:
+        release_body(hub, body_ref, len(batch) - retried)
+        if gone:  # 'Gone': send no further notifications
+            hub.storage.delete_many(gone)
+
+
+def release_parked(hub, host):
+    """Sends the notifications parked for host once its circuit closes.
+    Until then, a single one is sent every probe interval, to find out if
+    the host is up again.
+
+    """
+    breaker = hub.circuit_breaker
+    while True:
+        if breaker.closed(host):
+            deliveries = breaker.unpark(host, CHUNK_SIZE)
+            if deliveries:
+                logger.info(RELEASING_PARKED, host)
+                send_parked(hub, deliveries)
+                continue
+        else:
+            countdown = breaker.retry_after(host)
+            if not countdown:  # half-open
+                send_parked(hub, breaker.unpark(host, 1))
+                countdown = breaker.probe_interval
+            if breaker.parked(host):
+                breaker.claim_release(host, renew=True)
+                hub.release_parked.apply_async((host,), countdown=countdown)
+                return
+        breaker.end_release(host)
+        # notifications parked in the meantime would be left behind
+        if not breaker.parked(host) or not breaker.claim_release(host):
+            return
+
+
+def send_parked(hub, deliveries):
+    for *delivery, retries in deliveries:
+        hub.make_request_retrying.apply_async(delivery, retries=retries,
+                                              **lane_options(hub, 'retry'))
+
+
+def deliver(hub, callback, headers, body):
+    """Returns the status code, None if the notification should be retried,
+    or POSTPONED if it was not attempted because the host is down or its
+    rate limit was reached.
+
+    """
+    breaker, host = hub.circuit_breaker, callback_host(callback)
+    if breaker and not breaker.allow(host):
+        logger.info(CIRCUIT_OPEN, host)
+        return POSTPONED
+    if not rate_limit_acquired(hub, host):
+        return POSTPONED
+    try:
+        resp = timed_request(hub, 'POST', callback, headers=headers,
+                             data=body)
         assert 200 <= resp.status_code < 300 or resp.status_code == 410
     except (requests.exceptions.RequestException, AssertionError) as e:
         warn("Notification failed", e)
-        countdown = random.uniform(0, backoff_base * 2 ** self.request.retries)
-        self.retry(countdown=countdown)
-    else:
-        if resp.status_code == 410:  # 'Gone': send no further notifications
-            del hub.storage[topic_url, callback]
+        if breaker:
+            breaker.record_failure(host)
+        return None
+    if breaker:
+        breaker.record_success(host)
+    return resp.status_code
+
+
+def timed_request(hub, method, url, **kwargs):
+    """request_url, but reporting the result to the rate limiter."""
+
+    start = time.monotonic()
+    status_code = None
+    try:
+        response = request_url(hub.config, method, url, **kwargs)
+        status_code = response.status_code
+        return response
+    finally:
+        if hub.rate_limiter:
+            hub.rate_limiter.record(callback_host(url),
+                                    time.monotonic() - start,
+                                    hub.rate_limiter.overloaded(status_code))
+
+
+def rate_limit_acquired(hub, host):
+    if not hub.rate_limiter:
+        return True
+    # only wait as long as a (slow) request might take, so workers aren't
+    # blocked for long.
+    max_wait = hub.config.get('REQUEST_TIMEOUT', 3)
+    if hub.rate_limiter.wait(host, max_wait):
+        return True
+    logger.info(RATE_LIMITED, host)
+    return False
+
+
+class RateLimited(Exception):
+    """Raised when a verification request cannot be made yet, because the
+    rate limit of its callback host was reached. The task making it should be
+    run again later.
+
+    """
+
+
+def wait_for_rate_limit(hub, url):
+    if not rate_limit_acquired(hub, callback_host(url)):
+        raise RateLimited()
 
 
 # route helpers (for internal use only)
@@ -88,24 +727,40 @@ def subscribe(hub, callback_url, topic_url, lease_seconds, secret,
               endpoint_hook_data):
     """5.2 Subscription Validation"""
 
-    for validate in hub.validators:
-        error = validate(callback_url, topic_url, lease_seconds, secret,
-                         endpoint_hook_data)
-        if error:
-            send_denied(hub, callback_url, topic_url, error)
+    try:
+        if subscription_denied(hub, callback_url, topic_url, lease_seconds,
+                               secret, endpoint_hook_data):
             return
-
-    if intent_verified(hub, callback_url, 'subscribe', topic_url,
-                       lease_seconds):
+        verified = intent_verified(hub, callback_url, 'subscribe', topic_url,
+                                   lease_seconds)
+    except RateLimited:
+        hub.subscribe.apply_async((callback_url, topic_url, lease_seconds,
+                                   secret, endpoint_hook_data),
+                                  countdown=postponed_countdown(hub,
+                                                                callback_url))
+        return
+    if verified:
         hub.storage[topic_url, callback_url] = {
             'lease_seconds': lease_seconds,
             'secret': secret,
         }
 
 
+def subscription_denied(hub, callback_url, topic_url, lease_seconds, secret,
+                        endpoint_hook_data):
+    for validate in hub.validators:
+        error = validate(callback_url, topic_url, lease_seconds, secret,
+                         endpoint_hook_data)
+        if error:
+            send_denied(hub, callback_url, topic_url, error)
+            return True
+    return False
+
+
 def send_denied(hub, callback_url, topic_url, error):
+    wait_for_rate_limit(hub, callback_url)
     try:
-        request_url(hub.config, 'GET', callback_url, params={
+        timed_request(hub, 'GET', callback_url, params={
             'hub.mode': 'denied',
             'hub.topic': topic_url,
             'hub.reason': error,
@@ -124,14 +779,17 @@ def intent_verified(hub, callback_url, mode, topic_url, lease_seconds):
         'hub.challenge': challenge,
         'hub.lease_seconds': lease_seconds,
     }
+    wait_for_rate_limit(hub, callback_url)
     try:
-        response = request_url(hub.config, 'GET', callback_url, params=params)
+        response = timed_request(hub, 'GET', callback_url, params=params)
         assert response.status_code == 200 and response.text == challenge
     except requests.exceptions.RequestException as e:
         warn("Cannot verify subscriber intent", e)
     except AssertionError as e:
         warn(INTENT_UNVERIFIED % (response.status_code, response.content), e)
     else:
+        if mode == 'subscribe':
+            remember_encodings(hub, callback_url, response, lease_seconds)
         return True
     return False
 
@@ -139,6 +797,86 @@ def intent_verified(hub, callback_url, mode, topic_url, lease_seconds):
 def unsubscribe(hub, callback_url, topic_url, lease_seconds):
     # we could check here if the subscription actually exists, but that would
     # slow down the common case and just be more work.
-    if intent_verified(hub, callback_url, 'unsubscribe', topic_url,
-                       lease_seconds):
+    try:
+        verified = intent_verified(hub, callback_url, 'unsubscribe',
+                                   topic_url, lease_seconds)
+    except RateLimited:
+        hub.unsubscribe.apply_async((callback_url, topic_url, lease_seconds),
+                                    countdown=postponed_countdown(
+                                        hub, callback_url))
+        return
+    if verified:
         del hub.storage[topic_url, callback_url]
+
+
+def verify_intents(hub, intents):
+    """Handles a batch of subscription requests at once, as gathered by an
+    IntentBatcher. Every intent is a list of the form [mode, callback_url,
+    topic_url, lease_seconds, secret, endpoint_hook_data]. Up to
+    VERIFICATION_THREADS intents are verified concurrently, but never more
+    than VERIFICATION_PER_HOST for the same callback host. The results are
+    written to storage in bulk. Intents that cannot be verified yet because
+    of the rate limit of their callback host are handed to a new task.
+
+    """
+    threads = hub.config.get('VERIFICATION_THREADS', 16)
+    per_host = hub.config.get('VERIFICATION_PER_HOST', 2)
+    host_slots = {callback_host(intent[1]): threading.Semaphore(per_host)
+                  for intent in intents}
+
+    def verify(intent):
+        mode, callback_url, topic_url, lease_seconds, secret, hook = intent
+        with host_slots[callback_host(callback_url)]:
+            try:
+                if mode == 'subscribe' and subscription_denied(
+                        hub, callback_url, topic_url, lease_seconds, secret,
+                        hook):
+                    return False
+                return intent_verified(hub, callback_url, mode, topic_url,
+                                       lease_seconds)
+            except RateLimited:
+                return POSTPONED
+
+    # alternate between hosts, so the threads don't all end up waiting for
+    # the slots of a single one.
+    intents = interleave_by_host(intents)
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(verify, intents))
+
+    # postponed intents are verified again later, together with any other
+    # intents for the same subscription (to keep their order intact).
+    postponed_keys = {(intent[1], intent[2])
+                      for intent, ok in zip(intents, results)
+                      if ok is POSTPONED}
+    postponed = [intent for intent in intents
+                 if (intent[1], intent[2]) in postponed_keys]
+    if postponed:
+        countdown = max(postponed_countdown(hub, intent[1])
+                        for intent in postponed)
+        hub.verify_intents.apply_async((postponed,), countdown=countdown)
+    verified = [intent for intent, ok in zip(intents, results)
+                if ok is True and (intent[1], intent[2]) not in postponed_keys]
+    # keep the order of (un)subscriptions of the same callback intact
+    for mode, run in itertools.groupby(verified, key=lambda i: i[0]):
+        run = list(run)
+        if mode == 'subscribe':
+            hub.storage.set_many(((topic_url, callback_url), {
+                'lease_seconds': lease_seconds,
+                'secret': secret,
+            }) for _, callback_url, topic_url, lease_seconds, secret, _ in run)
+        else:
+            hub.storage.delete_many((topic_url, callback_url)
+                                    for _, callback_url, topic_url, *_ in run)
+
+
+def interleave_by_host(intents):
+    by_host = collections.defaultdict(collections.deque)
+    for intent in intents:
+        by_host[callback_host(intent[1])].append(intent)
+    result = []
+    while by_host:
+        for host in list(by_host):
+            result.append(by_host[host].popleft())
+            if not by_host[host]:
+                del by_host[host]
+    return result
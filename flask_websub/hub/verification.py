@@ -0,0 +1,51 @@
+import atexit
+import threading
+
+__all__ = ('IntentBatcher',)
+
+
+class IntentBatcher:
+    """Gathers the subscription requests received by a (web) process, and
+    passes them on to `send` (typically the delay method of the
+    verify_intents task) in batches of at most `batch_size` intents. A batch
+    that isn't full is sent after `delay` seconds, or when the process exits.
+
+    Intents that were received but not sent yet are lost when the process is
+    killed, so keep `delay` short.
+
+    """
+    def __init__(self, send, batch_size=100, delay=0.5):
+        self.send = send
+        self.batch_size = batch_size
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.pending = []
+        self.timer = None
+        atexit.register(self.flush)
+
+    def add(self, intent):
+        batch = None
+        with self.lock:
+            self.pending.append(intent)
+            if len(self.pending) >= self.batch_size:
+                batch = self.take()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        if batch:
+            self.send(batch)
+
+    def flush(self):
+        with self.lock:
+            batch = self.take()
+        if batch:
+            self.send(batch)
+
+    def take(self):
+        # requires self.lock
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        return batch
@@ -10,13 +10,34 @@ from ..errors import SubscriberError
 from .discovery import discover
 from .blueprint import build_blueprint
 from .events import EventMixin
+from .dispatch import AbstractNotificationQueue, MemoryNotificationQueue, \
+                      SQLite3NotificationQueue, NotificationDispatcher
 from .storage import WerkzeugCacheTempSubscriberStorage, \
-                     SQLite3TempSubscriberStorage, SQLite3SubscriberStorage
+                     SQLite3TempSubscriberStorage, SQLite3SubscriberStorage, \
+                     CachedSubscriberStorage, \
+                     AbstractAsyncTempSubscriberStorage, \
+                     AbstractAsyncSubscriberStorage, \
+                     AsyncTempSubscriberStorageAdapter, \
+                     AsyncSubscriberStorageAdapter, \
+                     AsyncSQLite3TempSubscriberStorage, \
+                     AsyncSQLite3SubscriberStorage, \
+                     SyncTempSubscriberStorageAdapter, \
+                     SyncSubscriberStorageAdapter
 
 from ..utils import warn
 
 __all__ = ('Subscriber', 'discover', 'WerkzeugCacheTempSubscriberStorage',
-           'SQLite3TempSubscriberStorage', 'SQLite3SubscriberStorage')
+           'SQLite3TempSubscriberStorage', 'SQLite3SubscriberStorage',
+           'CachedSubscriberStorage',
+           'AbstractAsyncTempSubscriberStorage',
+           'AbstractAsyncSubscriberStorage',
+           'AsyncTempSubscriberStorageAdapter',
+           'AsyncSubscriberStorageAdapter',
+           'AsyncSQLite3TempSubscriberStorage',
+           'AsyncSQLite3SubscriberStorage',
+           'SyncTempSubscriberStorageAdapter', 'SyncSubscriberStorageAdapter',
+           'AbstractNotificationQueue', 'MemoryNotificationQueue',
+           'SQLite3NotificationQueue', 'NotificationDispatcher')
 
 NO_SECRET_WITH_HTTP = ("Only specify a secret when using https. If you did "
                        "not pass one in yourself, disable AUTO_SET_SECRET.")
@@ -29,13 +50,24 @@ RENEW_FAILURE = "Could not renew subscription (%s, %s)"
 class Subscriber(EventMixin):
     """A subscriber takes the following constructor arguments:
 
-    - an AbstractSubscriberStorage instance for long-term data storage
+    - an AbstractSubscriberStorage instance for long-term data storage. Wrap
+      it in a CachedSubscriberStorage to save a storage query per incoming
+      notification.
     - an AbstractTempSubscriberStorage instance for short-term data storage
+    - dispatcher (optional): a NotificationDispatcher. If given, the hub gets
+      its response as soon as a notification is queued, instead of after
+      every listener finished. When the queue is full, notifications are
+      refused with '503 Service Unavailable', so the hub retries them later.
     - configuration values (optional); they are (with their default values):
         - REQUEST_TIMEOUT=3: Specifies how long to wait before considering a
           request to have failed.
         - MAX_BODY_SIZE=1024 * 1024: the maximum body size of a notification,
-          larger requests will be rejected. The default is 1MiB.
+          larger requests will be rejected. The default is 1MiB. Compressed
+          notifications (see the hub's COMPRESSION option) are decompressed,
+          and rejected as well if they would become larger than this.
+        - POOL_CONNECTIONS=10, POOL_MAXSIZE=10, POOL_BLOCK=False: tune the
+          per-process pool of keep-alive connections used for requests to
+          hubs. See the Hub class for details.
 
     It exposes the following methods:
 
@@ -64,8 +96,8 @@ class Subscriber(EventMixin):
       'unsubscribe'.
 
     """
-    def __init__(self, storage, temp_storage, **config):
-        super().__init__()
+    def __init__(self, storage, temp_storage, dispatcher=None, **config):
+        super().__init__(dispatcher)
 
         self.storage = storage
         self.temp_storage = temp_storage
@@ -77,8 +109,15 @@ class Subscriber(EventMixin):
 
         - url_prefix; this allows you to prefix the callback URLs in your app.
 
+        If the subscriber has a dispatcher, its workers start as soon as the
+        blueprint is registered on an app. Notifications left in a durable
+        queue by an earlier process are then processed right away.
+
         """
         self.blueprint_name, self.blueprint = build_blueprint(self, url_prefix)
+        if self.dispatcher:
+            self.blueprint.record_once(
+                lambda state: self.start_dispatcher(state.app))
         return self.blueprint
 
     def subscribe(self, **subscription_request):
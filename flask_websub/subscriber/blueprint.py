@@ -3,7 +3,8 @@ from flask import abort, request, Blueprint, Response
 import contextlib
 import hmac
 
-from ..utils import warn, parse_lease_seconds, calculate_hmac
+from ..utils import warn, parse_lease_seconds, calculate_hmac, \
+                    decompress, supported_encodings
 
 NOT_FOUND = "Could not found subscription with callback id '%s'"
 
@@ -64,6 +65,8 @@ def build_blueprint(subscriber, url_prefix):
         response = Response(challenge, status=200, mimetype=mimetype)
         response.headers['Content-Security-Policy'] = "default-src 'none'"
         response.headers['X-Content-Type-Options'] = 'nosniff'
+        # RFC 7694: let the hub know it can compress notifications
+        response.headers['Accept-Encoding'] = ', '.join(supported_encodings())
         return response
 
     @callbacks.route('/<callback_id>', methods=['POST'])
@@ -77,9 +80,18 @@ def build_blueprint(subscriber, url_prefix):
         if request.content_length > max_body_size:
             abort(400, "Body too large")
         body = request.get_data()
+        encoding = request.headers.get('Content-Encoding', 'identity').lower()
+        if encoding != 'identity':
+            try:
+                body = decompress(encoding, body, max_body_size)
+            except ValueError as e:
+                warn("Cannot decode notification body", e)
+                abort(415 if encoding not in supported_encodings() else 400)
         if body_is_valid(subscription, body):
-            subscriber.call_all('listeners', subscription['topic_url'],
-                                callback_id, body)
+            if not subscriber.notify(subscription['topic_url'], callback_id,
+                                     body):
+                # backpressure: the hub retries later
+                return 'Too many notifications\n', 503, {'Retry-After': '60'}
         return 'Content received\n'
 
     return name, callbacks
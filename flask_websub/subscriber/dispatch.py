@@ -0,0 +1,269 @@
+import abc
+import collections
+import queue
+import threading
+import time
+
+from ..utils import SQLite3StorageMixin, warn
+
+__all__ = ('AbstractNotificationQueue', 'MemoryNotificationQueue',
+           'SQLite3NotificationQueue', 'NotificationDispatcher')
+
+GIVING_UP = "Giving up on notification of %s for %s after %s attempts"
+QUEUE_FAILED = "Notification queue failed"
+QUEUE_ERROR_DELAY = 1
+
+
+class AbstractNotificationQueue(metaclass=abc.ABCMeta):
+    """Holds notifications until a listener has processed them. A
+    notification is a (topic_url, callback_id, body) tuple.
+
+    Implementations should take into account that methods can be called from
+    different threads.
+
+    """
+    @abc.abstractmethod
+    def put(self, notification):
+        """Add a notification to the queue. Return False if the queue is
+        full, True otherwise.
+
+        """
+
+    @abc.abstractmethod
+    def get(self, timeout):
+        """Wait at most timeout seconds for a notification, and return a
+        (token, notification) tuple, or None if there is none. Until the
+        token is passed to ack, the notification should be considered in
+        progress. A durable queue should hand it out again if it's never
+        acknowledged (e.g. because the process was killed).
+
+        """
+
+    @abc.abstractmethod
+    def ack(self, token):
+        """Remove the notification of token from the queue: it has been
+        processed.
+
+        """
+
+    @abc.abstractmethod
+    def __len__(self):
+        """The amount of notifications in the queue, including the ones that
+        are in progress.
+
+        """
+
+
+class MemoryNotificationQueue(AbstractNotificationQueue):
+    def __init__(self, max_size=1000):
+        """Keeps at most max_size notifications in memory. Notifications that
+        were not processed yet are lost when the process exits, and
+        notifications a listener failed on are not retried.
+
+        """
+        self.queue = queue.Queue(max_size)
+
+    def put(self, notification):
+        try:
+            self.queue.put_nowait(notification)
+        except queue.Full:
+            return False
+        return True
+
+    def get(self, timeout):
+        try:
+            return None, self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def ack(self, token):
+        pass
+
+    def __len__(self):
+        return self.queue.qsize()
+
+
+class SQLite3NotificationQueue(AbstractNotificationQueue, SQLite3StorageMixin):
+    TABLE_SETUP_SQL = """
+    create table if not exists notifications(
+        id integer primary key autoincrement,
+        topic_url text not null,
+        callback_id text not null,
+        body blob not null,
+        attempts integer not null default 0,
+        available_at real not null
+    )
+    """
+    INDEX_SETUP_SQL = ("""
+    create index if not exists notifications_available_at
+    on notifications(available_at)
+    """,)
+    PUT_SQL = """
+    insert into notifications(topic_url, callback_id, body, available_at)
+    select ?, ?, ?, 0 where (select count(*) from notifications) < ?
+    """
+    NEXT_SQL = """
+    select id, topic_url, callback_id, body, attempts from notifications
+    where available_at <= ? order by available_at, id limit 1
+    """
+    CLAIM_SQL = """
+    update notifications set available_at=?, attempts=attempts + 1
+    where id=? and available_at <= ?
+    """
+    ACK_SQL = "delete from notifications where id=?"
+    COUNT_SQL = "select count(*) from notifications"
+
+    def __init__(self, path, max_size=10000, visibility_timeout=300,
+                 max_attempts=5, poll_interval=0.5, **kwargs):
+        """Stores notifications in a SQLite database at path, so they survive
+        restarts. At most max_size notifications are kept. A notification
+        that is not acknowledged within visibility_timeout seconds is handed
+        out again, at most max_attempts times in total. Other processes
+        sharing the database are polled every poll_interval seconds. Other
+        keyword arguments are passed on to SQLite3StorageMixin.
+
+        """
+        self.max_size = max_size
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.available = threading.Condition()
+        super().__init__(path, **kwargs)
+
+    def put(self, notification):
+        with self.connection() as connection:
+            cursor = connection.execute(self.PUT_SQL,
+                                        tuple(notification) + (self.max_size,))
+        if not cursor.rowcount:
+            return False
+        with self.available:
+            self.available.notify()
+        return True
+
+    def get(self, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            result = self.claim()
+            remaining = deadline - time.monotonic()
+            if result or remaining <= 0:
+                return result
+            with self.available:
+                self.available.wait(min(remaining, self.poll_interval))
+
+    def claim(self):
+        while True:
+            now = time.time()
+            with self.connection() as connection:
+                row = connection.execute(self.NEXT_SQL, (now,)).fetchone()
+                if not row:
+                    return None
+                # only one process can claim a notification
+                args = (now + self.visibility_timeout, row['id'], now)
+                if not connection.execute(self.CLAIM_SQL, args).rowcount:
+                    continue
+            notification = (row['topic_url'], row['callback_id'],
+                            bytes(row['body']))
+            if row['attempts'] >= self.max_attempts:
+                warn(GIVING_UP % (notification[:2] + (row['attempts'],)),
+                     None)
+                self.ack(row['id'])
+                continue
+            return row['id'], notification
+
+    def ack(self, token):
+        with self.connection() as connection:
+            connection.execute(self.ACK_SQL, (token,))
+
+    def __len__(self):
+        with self.connection() as connection:
+            return connection.execute(self.COUNT_SQL).fetchone()[0]
+
+
+class NotificationDispatcher:
+    def __init__(self, queue=None, workers=4):
+        """Passes notifications to the listeners of a subscriber using
+        `workers` threads, so the hub gets its response without waiting for
+        them. Notifications wait in `queue`, an AbstractNotificationQueue (a
+        MemoryNotificationQueue by default). When it is full, notifications
+        are refused, so the hub retries them later.
+
+        A notification is only acknowledged after every listener processed it
+        without raising an exception. With a durable queue, that means every
+        notification is processed at least once, even if the process is
+        killed halfway.
+
+        """
+        if queue is None:
+            queue = MemoryNotificationQueue()
+        self.queue = queue
+        self.workers = workers
+        self.threads = []
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def start(self, app, handle):
+        """Start the worker threads (if that didn't happen yet). They call
+        handle(topic_url, callback_id, body) for every notification, inside
+        an app context of `app`.
+
+        """
+        with self.lock:
+            if self.threads:
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self.work,
+                                          args=(app, handle), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def dispatch(self, topic_url, callback_id, body):
+        """Returns False if the notification could not be queued."""
+
+        accepted = self.queue.put((topic_url, callback_id, bytes(body)))
+        self.count('accepted' if accepted else 'refused')
+        return accepted
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def work(self, app, handle):
+        while True:
+            try:
+                result = self.queue.get(timeout=1)
+            except Exception as e:
+                # e.g. a locked database. Nobody would restart the thread,
+                # so try again after a while.
+                warn(QUEUE_FAILED, e)
+                time.sleep(QUEUE_ERROR_DELAY)
+                continue
+            if result is None:
+                continue
+            token, notification = result
+            try:
+                with app.app_context():
+                    handle(*notification)
+            except Exception as e:
+                # not acknowledged, so a durable queue hands it out again
+                warn("Notification listener failed", e)
+                self.count('failed')
+            else:
+                try:
+                    self.queue.ack(token)
+                except Exception as e:
+                    # a durable queue hands it out again, which is still
+                    # at least once.
+                    warn(QUEUE_FAILED, e)
+                self.count('processed')
+
+    def stats(self):
+        """Returns a dict with the current queue depth, and the amount of
+        notifications that were accepted, refused (because the queue was
+        full), processed and failed since the dispatcher was created.
+
+        """
+        result = {'depth': len(self.queue)}
+        with self.lock:
+            for name in ['accepted', 'refused', 'processed', 'failed']:
+                result[name] = self.counts[name]
+        return result
@@ -1,8 +1,11 @@
 from flask import current_app
 
+import functools
+
 
 class EventMixin:
-    def __init__(self):
+    def __init__(self, dispatcher=None):
+        self.dispatcher = dispatcher
         self.listeners = set()
         self.error_handlers = set()
         self.success_handlers = set()
@@ -32,3 +35,20 @@ class EventMixin:
     def call_all(self, type, *args):
         for handler in getattr(self, type):
             handler(*args)
+
+    def notify(self, topic_url, callback_id, body):
+        """Calls the listeners, or has the dispatcher call them later (if
+        any). Returns False if the dispatcher could not accept the
+        notification.
+
+        """
+        if not self.dispatcher:
+            self.call_all('listeners', topic_url, callback_id, body)
+            return True
+        # normally started already, when the blueprint was registered
+        self.start_dispatcher(current_app._get_current_object())
+        return self.dispatcher.dispatch(topic_url, callback_id, body)
+
+    def start_dispatcher(self, app):
+        self.dispatcher.start(app, functools.partial(self.call_all,
+                                                     'listeners'))
@@ -1,12 +1,15 @@
 import abc
 
-from ..utils import SQLite3StorageMixin, warn
+from ..utils import SQLite3StorageMixin, ExecutorAdapterMixin, \
+                    LoopAdapterMixin, LocalCache, warn
 
 RACE_CONDITION = "WerkzeugCacheTempSubscriberStorage race condition."
 
 
 class SQLite3SubscriberStorageBase(SQLite3StorageMixin):
-    def __init__(self, path):
+    def __init__(self, path, **kwargs):
+        """See SQLite3StorageMixin for the arguments."""
+
         self.TABLE_SETUP_SQL = """
         create table if not exists {}(
             callback_id text primary key,
@@ -30,11 +33,17 @@ class SQLite3SubscriberStorageBase(SQLite3StorageMixin):
         where callback_id=? and expiration_time > strftime('%s', 'now');
         """.format(self.TABLE_NAME)
 
+        self.GETITEM_WITH_EXPIRATION_SQL = """
+        select mode, topic_url, hub_url, secret, lease_seconds,
+               expiration_time from {}
+        where callback_id=? and expiration_time > strftime('%s', 'now');
+        """.format(self.TABLE_NAME)
+
         self.DELITEM_SQL = """
         delete from {} where callback_id=?
         """.format(self.TABLE_NAME)
 
-        super().__init__(path)
+        super().__init__(path, **kwargs)
 
     def pop(self, callback_id):
         with self.connection() as connection:
@@ -170,6 +179,14 @@ class AbstractSubscriberStorage(metaclass=abc.ABCMeta):
     def pop(self, callback_id):
         """Atomic combination of __getitem__ and __delitem__."""
 
+    def get_with_expiration_time(self, callback_id):
+        """Like __getitem__, but returns a (subscription, expiration_time)
+        tuple, the latter being a unix timestamp. Override this method if your
+        backend knows it, the default implementation returns None instead.
+
+        """
+        return self[callback_id], None
+
 
 class SQLite3SubscriberStorage(AbstractSubscriberStorage,
                                SQLite3SubscriberStorageBase):
@@ -201,9 +218,219 @@ class SQLite3SubscriberStorage(AbstractSubscriberStorage,
                                             subscription['lease_seconds'],
                                             subscription['lease_seconds']))
 
+    def get_with_expiration_time(self, callback_id):
+        with self.connection() as connection:
+            cursor = connection.execute(self.GETITEM_WITH_EXPIRATION_SQL,
+                                        (callback_id,))
+            result = cursor.fetchone()
+            if result:
+                subscription = dict(result)
+                return subscription, subscription.pop('expiration_time')
+            raise KeyError(callback_id)
+
     def close_to_expiration(self, margin_in_seconds):
         args = (margin_in_seconds,)
         with self.connection() as conn:
             yield from iter(conn.execute(self.CLOSE_TO_EXPIRATION_SQL, args))
 
     pop = SQLite3SubscriberStorageBase.pop
+
+
+class CachedSubscriberStorage(AbstractSubscriberStorage):
+    def __init__(self, storage, versions=None, timeout=60, max_size=4096):
+        """Keeps recently used subscriptions in memory, in front of another
+        AbstractSubscriberStorage instance: `storage`. This saves a storage
+        query for every incoming notification. Cached subscriptions are used
+        for at most `timeout` seconds, and never after they expire. At most
+        `max_size` subscriptions are cached.
+
+        Writes through this object invalidate the cache of the current
+        process. To also invalidate the caches of other processes, pass in a
+        cache that is shared between them as `versions`, like for
+        flask_websub.hub.CachedHubStorage.
+
+        """
+        self.storage = storage
+        self.subscriptions = LocalCache(versions, 'subscriber-version:',
+                                        timeout, max_size)
+
+    def __getitem__(self, callback_id):
+        return self.get_with_expiration_time(callback_id)[0]
+
+    def get_with_expiration_time(self, callback_id):
+        subscription, expiration_time = self.subscriptions.get(
+            callback_id, lambda: self.fetch(callback_id))
+        return dict(subscription), expiration_time
+
+    def fetch(self, callback_id):
+        subscription, expiration_time = \
+            self.storage.get_with_expiration_time(callback_id)
+        return (dict(subscription), expiration_time), expiration_time
+
+    def __delitem__(self, callback_id):
+        del self.storage[callback_id]
+        self.invalidate(callback_id)
+
+    def __setitem__(self, callback_id, subscription):
+        self.storage[callback_id] = subscription
+        self.invalidate(callback_id)
+
+    def pop(self, callback_id):
+        try:
+            return self.storage.pop(callback_id)
+        finally:
+            self.invalidate(callback_id)
+
+    def close_to_expiration(self, margin_in_seconds):
+        return self.storage.close_to_expiration(margin_in_seconds)
+
+    def invalidate(self, callback_id):
+        self.subscriptions.invalidate(callback_id)
+
+
+# asyncio
+
+class AbstractAsyncTempSubscriberStorage(metaclass=abc.ABCMeta):
+    """The asyncio counterpart of AbstractTempSubscriberStorage, with a
+    set() method instead of item assignment.
+
+    """
+    @abc.abstractmethod
+    async def set(self, callback_id, subscription_request):
+        """See AbstractTempSubscriberStorage.__setitem__"""
+
+    @abc.abstractmethod
+    async def pop(self, callback_id):
+        """See AbstractTempSubscriberStorage.pop"""
+
+    async def cleanup(self):
+        """See AbstractTempSubscriberStorage.cleanup"""
+
+
+class AbstractAsyncSubscriberStorage(metaclass=abc.ABCMeta):
+    """The asyncio counterpart of AbstractSubscriberStorage, with get(),
+    set() and delete() methods instead of item access.
+
+    """
+    @abc.abstractmethod
+    async def get(self, callback_id):
+        """See AbstractSubscriberStorage.__getitem__"""
+
+    @abc.abstractmethod
+    async def delete(self, callback_id):
+        """See AbstractSubscriberStorage.__delitem__"""
+
+    @abc.abstractmethod
+    async def set(self, callback_id, subscription):
+        """See AbstractSubscriberStorage.__setitem__"""
+
+    @abc.abstractmethod
+    def close_to_expiration(self, margin_in_seconds):
+        """An asynchronous generator function, see
+        AbstractSubscriberStorage.close_to_expiration.
+
+        """
+
+    @abc.abstractmethod
+    async def pop(self, callback_id):
+        """See AbstractSubscriberStorage.pop"""
+
+
+class AsyncTempSubscriberStorageAdapter(ExecutorAdapterMixin,
+                                        AbstractAsyncTempSubscriberStorage):
+    """Makes an AbstractTempSubscriberStorage usable from asyncio code. See
+    flask_websub.hub.AsyncHubStorageAdapter.
+
+    """
+    async def set(self, callback_id, subscription_request):
+        await self.run(self.wrapped.__setitem__, callback_id,
+                       subscription_request)
+
+    async def pop(self, callback_id):
+        return await self.run(self.wrapped.pop, callback_id)
+
+    async def cleanup(self):
+        await self.run(self.wrapped.cleanup)
+
+
+class AsyncSubscriberStorageAdapter(ExecutorAdapterMixin,
+                                    AbstractAsyncSubscriberStorage):
+    """Makes an AbstractSubscriberStorage usable from asyncio code. See
+    flask_websub.hub.AsyncHubStorageAdapter.
+
+    """
+    async def get(self, callback_id):
+        return await self.run(self.wrapped.__getitem__, callback_id)
+
+    async def delete(self, callback_id):
+        await self.run(self.wrapped.__delitem__, callback_id)
+
+    async def set(self, callback_id, subscription):
+        await self.run(self.wrapped.__setitem__, callback_id, subscription)
+
+    async def close_to_expiration(self, margin_in_seconds):
+        subscriptions = await self.run(
+            list, self.wrapped.close_to_expiration(margin_in_seconds))
+        for subscription in subscriptions:
+            yield subscription
+
+    async def pop(self, callback_id):
+        return await self.run(self.wrapped.pop, callback_id)
+
+
+class AsyncSQLite3TempSubscriberStorage(AsyncTempSubscriberStorageAdapter):
+    def __init__(self, path, max_workers=4, **kwargs):
+        """See flask_websub.hub.AsyncSQLite3HubStorage"""
+
+        kwargs.setdefault('persistent', True)
+        super().__init__(SQLite3TempSubscriberStorage(path, **kwargs),
+                         max_workers)
+
+
+class AsyncSQLite3SubscriberStorage(AsyncSubscriberStorageAdapter):
+    def __init__(self, path, max_workers=4, **kwargs):
+        """See flask_websub.hub.AsyncSQLite3HubStorage"""
+
+        kwargs.setdefault('persistent', True)
+        super().__init__(SQLite3SubscriberStorage(path, **kwargs),
+                         max_workers)
+
+
+class SyncTempSubscriberStorageAdapter(LoopAdapterMixin,
+                                       AbstractTempSubscriberStorage):
+    """Makes an AbstractAsyncTempSubscriberStorage usable as an
+    AbstractTempSubscriberStorage. See
+    flask_websub.hub.SyncHubStorageAdapter.
+
+    """
+    def __setitem__(self, callback_id, subscription_request):
+        self.run(self.wrapped.set(callback_id, subscription_request))
+
+    def pop(self, callback_id):
+        return self.run(self.wrapped.pop(callback_id))
+
+    def cleanup(self):
+        self.run(self.wrapped.cleanup())
+
+
+class SyncSubscriberStorageAdapter(LoopAdapterMixin,
+                                   AbstractSubscriberStorage):
+    """Makes an AbstractAsyncSubscriberStorage usable as an
+    AbstractSubscriberStorage. See flask_websub.hub.SyncHubStorageAdapter.
+
+    """
+    def __getitem__(self, callback_id):
+        return self.run(self.wrapped.get(callback_id))
+
+    def __delitem__(self, callback_id):
+        self.run(self.wrapped.delete(callback_id))
+
+    def __setitem__(self, callback_id, subscription):
+        self.run(self.wrapped.set(callback_id, subscription))
+
+    def close_to_expiration(self, margin_in_seconds):
+        return self.iterate(self.wrapped.close_to_expiration(
+            margin_in_seconds))
+
+    def pop(self, callback_id):
+        return self.run(self.wrapped.pop(callback_id))
@@ -1,12 +1,28 @@
 from flask import abort
 import requests
+import requests.adapters
 
+import asyncio
+import collections
+import concurrent.futures
 import contextlib
+import functools
 import hashlib
 import hmac
+import http.cookiejar
+import itertools
 import logging
+import os
 import sqlite3
+import threading
+import time
 import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
 
 INVALID_LEASE = "Invalid hub.lease_seconds (should be a positive integer)"
 A_MINUTE = 60
@@ -31,7 +47,60 @@ def request_url(config, *args, **kwargs):
     # 3 seconds seems reasonable even for slow/far away servers, as websub
     # requests should not do elaborate processing anyway.
     kwargs['timeout'] = config.get('REQUEST_TIMEOUT', 3)
-    return requests.request(*args, **kwargs)
+    return get_session(config).request(*args, **kwargs)
+
+
+# one pool of keep-alive connections per process (and pool configuration),
+# shared by the hub and subscriber.
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(config):
+    """Returns the requests.Session for this process. The connection pool can
+    be tuned using the following config values (defaults shown):
+
+    - POOL_CONNECTIONS=10: the amount of hosts to keep connections open to.
+    - POOL_MAXSIZE=10: the maximum amount of connections kept open per host.
+    - POOL_BLOCK=False: if True, POOL_MAXSIZE is a hard limit on the amount of
+      simultaneous connections to a single host.
+
+    """
+    key = (config.get('POOL_CONNECTIONS', 10), config.get('POOL_MAXSIZE', 10),
+           config.get('POOL_BLOCK', False))
+    with sessions_lock:
+        try:
+            return sessions[key]
+        except KeyError:
+            session = sessions[key] = build_session(*key)
+            return session
+
+
+def build_session(pool_connections, pool_maxsize, pool_block):
+    session = requests.Session()
+    # the session is shared by all callbacks and topics, so it should never
+    # send the cookies of one of them to another.
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(
+        allowed_domains=[]))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                            pool_maxsize=pool_maxsize,
+                                            pool_block=pool_block)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def reset_sessions():
+    # a forked child (e.g. a celery worker process) shares its sockets with
+    # the parent, so it should never re-use the parent's connections.
+    global sessions_lock
+
+    sessions_lock = threading.Lock()
+    sessions.clear()
+
+
+if hasattr(os, 'register_at_fork'):  # not on Windows
+    os.register_at_fork(after_in_child=reset_sessions)
 
 
 logger = logging.getLogger('flask_websub')
@@ -46,8 +115,87 @@ def calculate_hmac(algorithm, secret, data):
     return hmac.new(secret.encode('UTF-8'), data, hash).hexdigest()
 
 
-def get_content(config, topic_url):
-    updated_content = request_url(config, 'GET', topic_url, stream=True)
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def body_digest(body):
+    return 'sha256:' + hashlib.sha256(body).hexdigest()
+
+
+def supported_encodings():
+    """The content codings that can be (de)compressed, in order of
+    preference.
+
+    """
+    return ['zstd', 'gzip'] if zstandard else ['gzip']
+
+
+def parse_accept_encoding(header):
+    """Returns the set of content codings accepted by an Accept-Encoding
+    header, ignoring the ones with a q-value of 0.
+
+    """
+    accepted = set()
+    for item in (header or '').split(','):
+        coding, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding.lower())
+    return accepted
+
+
+def compress(encoding, body):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor().compress(body)
+    raise ValueError("Unsupported content coding: " + encoding)
+
+
+def decompress(encoding, body, max_size):
+    """Raises ValueError if the body cannot be decompressed, or if it would
+    become larger than max_size bytes.
+
+    """
+    try:
+        if encoding == 'gzip':
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+            result = decompressor.decompress(body, max_size + 1)
+            complete = decompressor.eof
+        elif encoding == 'zstd' and zstandard:
+            size = zstandard.get_frame_parameters(body).content_size
+            decompressor = zstandard.ZstdDecompressor()
+            with decompressor.stream_reader(body) as reader:
+                result = reader.read(max_size + 1)
+            complete = size in (len(result), zstandard.CONTENTSIZE_UNKNOWN)
+        else:
+            raise ValueError("Unsupported content coding: " + encoding)
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise ValueError("Invalid compressed body") from e
+    if len(result) > max_size:
+        raise ValueError("Decompressed body too large")
+    if not complete:
+        raise ValueError("Invalid compressed body")
+    return result
+
+
+def get_content(config, topic_url, headers=None):
+    updated_content = request_url(config, 'GET', topic_url, stream=True,
+                                  headers=headers)
     updated_content.raise_for_status()
     return updated_content
 
@@ -59,21 +207,221 @@ def secret_too_big(secret):
 
 
 class SQLite3StorageMixin:
-    def __init__(self, path):
-        """Path should be where you want to save the sqlite3 database."""
+    # allow writing and reading simultaneously:
+    DEFAULT_PRAGMAS = {'journal_mode': 'wal'}
+    INDEX_SETUP_SQL = ()
 
+    def __init__(self, path, persistent=False, pragmas=None,
+                 cached_statements=128):
+        """Path should be where you want to save the sqlite3 database.
+
+        By default, a new connection is made for every operation. If
+        persistent is True, every thread (in every process) keeps its own
+        connection open instead, which saves the connection overhead and
+        allows re-using prepared statements (at most cached_statements of
+        them per connection).
+
+        pragmas is a dict of extra PRAGMA values that are set once on each new
+        connection. For busy databases, the following is a good start:
+        {'synchronous': 'normal', 'cache_size': -16000, 'mmap_size':
+        256 * 1024 * 1024, 'busy_timeout': 5000}
+
+        """
         self.path = path
+        self.persistent = persistent
+        self.pragmas = dict(self.DEFAULT_PRAGMAS, **(pragmas or {}))
+        self.cached_statements = cached_statements
+        self.local = threading.local()
+        self.pid = os.getpid()
         with self.connection() as connection:
             connection.execute(self.TABLE_SETUP_SQL)
+            for sql in self.INDEX_SETUP_SQL:
+                connection.execute(sql)
 
     @contextlib.contextmanager
     def connection(self):
-        connection = sqlite3.connect(self.path)
+        if self.persistent:
+            connection = self.thread_connection()
+            with connection:
+                yield connection
+            return
+
+        connection = self.connect()
         try:
-            connection.row_factory = sqlite3.Row
-            # allow writing and reading simultaneously:
             with connection:
-                connection.execute('PRAGMA journal_mode=wal')
                 yield connection
         finally:
             connection.close()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path,
+                                     cached_statements=self.cached_statements)
+        connection.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            connection.execute('PRAGMA %s=%s' % (name, value))
+        return connection
+
+    def thread_connection(self):
+        if self.pid != os.getpid():
+            # a connection should never be used in more than one process, so
+            # forget all connections inherited from the parent process.
+            self.local = threading.local()
+            self.pid = os.getpid()
+        try:
+            return self.local.connection
+        except AttributeError:
+            self.local.connection = self.connect()
+            return self.local.connection
+
+    def close(self):
+        """Closes the persistent connection of the current thread (if any)."""
+
+        connection = getattr(self.local, 'connection', None)
+        if connection:
+            del self.local.connection
+            connection.close()
+
+
+class ExecutorAdapterMixin:
+    """Base class for adapters that make a synchronous object (`wrapped`)
+    usable from asyncio code, by running its methods in a pool of at most
+    `max_workers` threads (or in `executor`, if given).
+
+    """
+    def __init__(self, wrapped, max_workers=4, executor=None):
+        self.wrapped = wrapped
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.executor = executor
+
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(function, *args))
+
+    async def iterate_pages(self, pages):
+        """Yields every item of every page (a list) of the iterator `pages`,
+        fetching a single page per thread hop.
+
+        """
+        async for page in self.pages(pages):
+            for item in page:
+                yield item
+
+    async def pages(self, pages):
+        while True:
+            page = await self.run(next, pages, None)
+            if page is None:
+                return
+            yield page
+
+
+class LoopAdapterMixin:
+    """Base class for adapters that make an asyncio object (`wrapped`) usable
+    from synchronous code, by running its coroutines on `loop`. That loop
+    should run in another thread. If no loop is given, a new one is started
+    in a background thread.
+
+    """
+    def __init__(self, wrapped, loop=None):
+        self.wrapped = wrapped
+        self.loop = loop or background_loop()
+
+    def run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def iterate(self, async_iterable):
+        async_iterator = async_iterable.__aiter__()
+        while True:
+            try:
+                yield self.run(next_item(async_iterator))
+            except StopAsyncIteration:
+                return
+
+
+class LocalCache:
+    """Keeps at most `max_size` recently used values in memory, in front of
+    slower storage. A value is used for at most `timeout` seconds.
+
+    Call invalidate after every write to the storage. To also invalidate the
+    values cached by other processes, pass in a cache that is shared between
+    them as `versions` (it should share the API of cachelib.BaseCache). It is
+    used to store a version number per key (prefixed by `version_prefix`),
+    which is checked before using a cached value.
+
+    """
+    def __init__(self, versions=None, version_prefix='', timeout=60,
+                 max_size=1024):
+        self.versions = versions
+        self.version_prefix = version_prefix
+        self.timeout = timeout
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        # key -> [generation, amount of fetches in progress]. The generation
+        # is bumped by invalidate, so a fetch that started before a write of
+        # this process never caches what it read.
+        self.fetching = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        """Returns the cached value of key, or calls fetch to get it. fetch
+        should return a (value, expiration_time) tuple: the value is never
+        used after expiration_time (a unix timestamp, or None).
+
+        """
+        # version first, so concurrent writes invalidate the new entry
+        version = self.current_version(key)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == version and now < entry[1]:
+                self.entries.move_to_end(key)
+                return entry[2]
+            fetching = self.fetching.setdefault(key, [0, 0])
+            fetching[1] += 1
+            generation = fetching[0]
+
+        try:
+            value, expiration_time = fetch()
+        except BaseException:
+            with self.lock:
+                self.done_fetching(key, fetching)
+            raise
+        valid_until = now + self.timeout
+        if expiration_time is not None:
+            valid_until = min(valid_until, expiration_time)
+        with self.lock:
+            self.done_fetching(key, fetching)
+            if fetching[0] == generation:
+                self.entries[key] = (version, valid_until, value)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def done_fetching(self, key, fetching):
+        fetching[1] -= 1
+        if not fetching[1]:
+            del self.fetching[key]
+
+    def invalidate(self, key):
+        if self.versions:
+            self.versions.inc(self.version_prefix + key)
+        with self.lock:
+            self.entries.pop(key, None)
+            if key in self.fetching:
+                self.fetching[key][0] += 1
+
+    def current_version(self, key):
+        if self.versions:
+            return self.versions.get(self.version_prefix + key)
+
+
+async def next_item(async_iterator):
+    return await async_iterator.__anext__()
+
+
+def background_loop():
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
@@ -21,7 +21,10 @@ setup(
     extras_require={
         'celery': ['celery>=4.3.0'],
         'redis': ['redis'],
+        'async': ['aiohttp'],
+        'zstd': ['zstandard'],
         'dev': [
+            'aiohttp',
             'cachelib',
             'flake8',
             'pyOpenSSL',
@@ -29,7 +32,9 @@ setup(
             'pytest-celery',
             'pytest-cov',
             'pytest-runner',
+            'redis',
             'Sphinx',
+            'zstandard',
         ],
     },
     classifiers=[
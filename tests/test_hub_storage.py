@@ -0,0 +1,400 @@
+from cachelib import SimpleCache
+import pytest
+
+import asyncio
+import time
+from unittest.mock import Mock, patch
+
+from flask_websub.hub import SQLite3HubStorage, CachedHubStorage, \
+                             RedisHubStorage, ShardedHubStorage, \
+                             migrate_subscriptions, AsyncSQLite3HubStorage, \
+                             AsyncHubStorageAdapter, SyncHubStorageAdapter, \
+                             FileSystemBodyStore, CacheBodyStore
+from flask_websub.hub.storage import AbstractHubStorage
+from flask_websub.utils import body_digest
+from .utils import FakeRedis
+
+
+@pytest.fixture
+def hub_storage(tmp_path):
+    return SQLite3HubStorage(str(tmp_path / 'hub.db'))
+
+
+def subscribe(storage, topic_url, callback_url, lease_seconds=60):
+    storage[topic_url, callback_url] = {
+        'lease_seconds': lease_seconds,
+        'secret': None,
+    }
+
+
+def callbacks(storage, topic_url):
+    return [tuple(row) for row in storage.get_callbacks(topic_url)]
+
+
+def test_persistent_connection(tmp_path):
+    storage = SQLite3HubStorage(str(tmp_path / 'hub.db'), persistent=True,
+                                pragmas={'synchronous': 'normal'})
+    subscribe(storage, 'topic', 'a')
+    with storage.connection() as connection:
+        assert connection is storage.local.connection
+        synchronous = connection.execute('PRAGMA synchronous').fetchone()[0]
+        assert synchronous == 1  # normal
+    assert callbacks(storage, 'topic') == [('a', None)]
+    storage.close()
+    assert callbacks(storage, 'topic') == [('a', None)]
+    assert storage.local.connection is not connection
+
+
+def test_bulk(hub_storage, tmp_path):
+    value = {'lease_seconds': 60, 'secret': 'abc'}
+    hub_storage.set_many(((topic, callback), value)
+                         for topic in ['t1', 't2'] for callback in 'abc')
+    hub_storage.delete_many([('t1', 'a'), ('t2', 'c')])
+    assert callbacks(hub_storage, 't1') == [('b', 'abc'), ('c', 'abc')]
+    assert callbacks(hub_storage, 't2') == [('a', 'abc'), ('b', 'abc')]
+
+    exported = list(hub_storage.export_subscriptions())
+    assert len(exported) == 4
+    copy = CachedHubStorage(SQLite3HubStorage(str(tmp_path / 'copy.db')))
+    assert list(copy.get_callbacks('t1')) == []
+    copy.import_subscriptions(exported)
+    assert list(copy.get_callbacks('t1')) == [('b', 'abc'), ('c', 'abc')]
+    assert sorted(map(tuple, copy.export_subscriptions())) == \
+        sorted(map(tuple, exported))
+
+
+def test_export_pages(hub_storage):
+    for topic in ['t1', 't2']:
+        for callback in 'ba':
+            subscribe(hub_storage, topic, callback)
+    subscribe(hub_storage, 't1', 'c', lease_seconds=-1)  # expired
+    pages = [[tuple(row)[:2] for row in page]
+             for page in hub_storage.export_subscription_pages(3)]
+    assert pages == [[('t1', 'a'), ('t1', 'b'), ('t2', 'a')], [('t2', 'b')]]
+
+
+class DictHubStorage(AbstractHubStorage):
+    """Without export_subscriptions."""
+
+    def __init__(self):
+        self.data = {}
+
+    def __delitem__(self, key):
+        self.data.pop(key, None)
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def get_callbacks(self, topic_url):
+        for (topic, callback_url), value in self.data.items():
+            if topic == topic_url:
+                yield callback_url, value['secret']
+
+
+def test_export_not_supported(hub_storage):
+    subscribe(hub_storage, 'topic', 'a')
+    storage = DictHubStorage()
+    subscribe(storage, 'topic', 'b')
+    with pytest.raises(NotImplementedError):
+        migrate_subscriptions(storage, hub_storage)
+    assert callbacks(hub_storage, 'topic') == [('a', None)]
+
+    sharded = ShardedHubStorage({'a': hub_storage, 'b': storage})
+    with pytest.raises(NotImplementedError):
+        sharded.export_subscriptions()
+    with pytest.raises(NotImplementedError):
+        sharded.rebalance()
+    # nothing was moved
+    assert callbacks(hub_storage, 'topic') == [('a', None)]
+
+
+def test_callback_pages(hub_storage):
+    for callback in 'ecadb':
+        subscribe(hub_storage, 'topic', callback)
+    subscribe(hub_storage, 'topic', 'f', lease_seconds=-1)  # expired
+    subscribe(hub_storage, 'other', 'g')
+    pages = [[row['callback_url'] for row in page]
+             for page in hub_storage.get_callback_pages('topic', 2)]
+    assert pages == [['a', 'b'], ['c', 'd'], ['e']]
+
+    cached = CachedHubStorage(hub_storage)
+    assert [len(p) for p in cached.get_callback_pages('topic', 4)] == [4, 1]
+
+
+def test_cleanup(hub_storage):
+    for callback in 'abc':
+        subscribe(hub_storage, 'topic', callback, lease_seconds=-1)
+    subscribe(hub_storage, 'topic', 'd')
+    assert hub_storage.cleanup_expired_subscriptions(batch_size=2) == 3
+    assert hub_storage.cleanup_expired_subscriptions() == 0
+    assert callbacks(hub_storage, 'topic') == [('d', None)]
+
+
+def test_cached_hub_storage(hub_storage):
+    versions = SimpleCache(default_timeout=0)
+    cached = CachedHubStorage(hub_storage, versions)
+    other_process = CachedHubStorage(hub_storage, versions)
+    subscribe(cached, 'topic', 'a')
+    assert list(other_process.get_callbacks('topic')) == [('a', None)]
+
+    # cached in memory
+    subscribe(hub_storage, 'topic', 'b')
+    assert list(other_process.get_callbacks('topic')) == [('a', None)]
+
+    # invalidated by writes elsewhere
+    del cached['topic', 'a']
+    assert list(other_process.get_callbacks('topic')) == [('b', None)]
+
+
+def test_cached_hub_storage_race(hub_storage):
+    cached = CachedHubStorage(hub_storage)
+    subscribe(cached, 'topic', 'a')
+    get_subscriptions = hub_storage.get_subscriptions
+
+    def racing_get_subscriptions(topic_url):
+        subscriptions = list(get_subscriptions(topic_url))
+        # a write finishes while the old callbacks are being read
+        subscribe(cached, topic_url, 'b')
+        return subscriptions
+
+    with patch.object(hub_storage, 'get_subscriptions',
+                      racing_get_subscriptions):
+        assert callbacks(cached, 'topic') == [('a', None)]
+    # the outdated callbacks were not cached
+    assert sorted(callbacks(cached, 'topic')) == [('a', None), ('b', None)]
+    assert not cached.topics.fetching
+
+
+def test_cached_hub_storage_expiration(hub_storage):
+    cached = CachedHubStorage(hub_storage, max_topics=1)
+    subscribe(cached, 'topic', 'a', lease_seconds=1)
+    assert list(cached.get_callbacks('topic')) == [('a', None)]
+    valid_until = cached.topics.entries['topic'][1]
+    assert valid_until <= time.time() + 1
+
+    assert list(cached.get_callbacks('other')) == []
+    assert list(cached.topics.entries) == ['other']
+
+
+@pytest.fixture
+def redis_storage():
+    return RedisHubStorage(FakeRedis(), batch_size=2)
+
+
+def test_redis_hub_storage(redis_storage):
+    value = {'lease_seconds': 60, 'secret': 'abc'}
+    redis_storage.set_many(((topic, callback), value)
+                           for topic in ['t1', 't2'] for callback in 'abc')
+    subscribe(redis_storage, 't1', 'd')
+    subscribe(redis_storage, 't1', 'e', lease_seconds=-1)  # expired
+    redis_storage.delete_many([('t1', 'a'), ('t2', 'c')])
+    assert sorted(redis_storage.get_callbacks('t1')) == [
+        ('b', 'abc'), ('c', 'abc'), ('d', None)
+    ]
+    exported = list(redis_storage.export_subscriptions())
+    assert len(exported) == 5
+    copy = RedisHubStorage(FakeRedis())
+    copy.import_subscriptions(exported)
+    assert sorted(copy.export_subscriptions()) == sorted(exported)
+
+
+def test_redis_callback_pages(redis_storage):
+    now = time.time()
+    # ties in expiration time should neither be skipped nor repeated
+    redis_storage.import_subscriptions(
+        ('topic', callback, None, now + 60) for callback in 'abcde')
+    subscribe(redis_storage, 'topic', 'f', lease_seconds=120)
+    subscribe(redis_storage, 'topic', 'g', lease_seconds=-1)
+    pages = [[callback for callback, secret in page]
+             for page in redis_storage.get_callback_pages('topic', 2)]
+    assert pages == [['a', 'b'], ['c', 'd'], ['e', 'f']]
+
+
+def test_redis_cleanup(redis_storage):
+    for callback in 'abc':
+        subscribe(redis_storage, 'topic', callback, lease_seconds=-1)
+    subscribe(redis_storage, 'topic', 'd')
+    subscribe(redis_storage, 'gone', 'e', lease_seconds=-1)
+    assert redis_storage.cleanup_expired_subscriptions() == 4
+    assert redis_storage.cleanup_expired_subscriptions() == 0
+    assert list(redis_storage.get_callbacks('topic')) == [('d', None)]
+    topics = redis_storage.redis.sscan_iter(redis_storage.topics_key())
+    assert topics == [b'topic']
+
+
+def test_redis_cleanup_conflict(redis_storage):
+    subscribe(redis_storage, 'topic', 'a', lease_seconds=-1)
+    redis, zcard = redis_storage.redis, redis_storage.redis.zcard
+
+    def concurrent_zcard(key):
+        # renews the subscription while it is being cleaned up
+        redis.zcard = zcard
+        subscribe(redis_storage, 'topic', 'a')
+        return zcard(key)
+    redis.zcard = concurrent_zcard
+    assert redis_storage.cleanup_expired_subscriptions() == 0
+    assert list(redis_storage.get_callbacks('topic')) == [('a', None)]
+
+
+def sqlite_shards(tmp_path, names):
+    return {name: SQLite3HubStorage(str(tmp_path / (name + '.db')))
+            for name in names}
+
+
+def test_sharded_hub_storage(tmp_path):
+    storage = ShardedHubStorage(sqlite_shards(tmp_path, ['a', 'b', 'c']))
+    topics = ['topic%s' % i for i in range(20)]
+    value = {'lease_seconds': 60, 'secret': None}
+    storage.set_many(((topic, 'cb'), value) for topic in topics)
+    subscribe(storage, 'topic0', 'expired', lease_seconds=-1)
+    storage.delete_many([('topic1', 'cb')])
+    for topic in topics:
+        shard = storage.shard(topic)
+        expected = [] if topic == 'topic1' else [('cb', None)]
+        assert callbacks(shard, topic) == expected
+        assert callbacks(storage, topic) == expected
+    # every shard gets used
+    assert all(list(shard.export_subscriptions())
+               for shard in storage.shards.values())
+    assert storage.cleanup_expired_subscriptions() == 1
+
+
+def test_sharded_rebalance(tmp_path):
+    single = SQLite3HubStorage(str(tmp_path / 'single.db'))
+    for i in range(20):
+        subscribe(single, 'topic%s' % i, 'cb')
+    storage = ShardedHubStorage(sqlite_shards(tmp_path, ['a', 'b']))
+    assert migrate_subscriptions(single, storage) == 20
+
+    storage.shards.update(sqlite_shards(tmp_path, ['c']))
+    moved = storage.rebalance()
+    # only subscriptions of topics now belonging to the new shard moved
+    assert moved == len(list(storage.shards['c'].export_subscriptions()))
+    assert 0 < moved < 20
+    assert storage.rebalance() == 0
+    for i in range(20):
+        assert callbacks(storage, 'topic%s' % i) == [('cb', None)]
+
+
+def test_sharded_rebalance_keeps_newer(tmp_path):
+    storage = ShardedHubStorage(sqlite_shards(tmp_path, ['a']))
+    topics = ['topic%s' % i for i in range(20)]
+    for topic in topics:
+        storage[topic, 'cb'] = {'lease_seconds': 60, 'secret': 'old'}
+
+    storage.shards.update(sqlite_shards(tmp_path, ['b']))
+    moved = [topic for topic in topics if storage.shard_name(topic) == 'b']
+    assert moved
+    # re-subscribing after the shard was added writes to the new shard
+    for topic in moved:
+        storage[topic, 'cb'] = {'lease_seconds': 120, 'secret': 'new'}
+    assert storage.rebalance() == len(moved)
+    for topic in topics:
+        secret = 'new' if topic in moved else 'old'
+        assert callbacks(storage, topic) == [('cb', secret)]
+    assert not list(storage.shards['a'].get_callbacks(moved[0]))
+
+
+def test_merge_subscriptions(hub_storage, redis_storage, tmp_path):
+    now = time.time()
+    merged = [('topic', 'a', 'newer', now + 120),
+              ('topic', 'b', 'older', now + 30),
+              ('topic', 'c', 'added', now + 60)]
+    # the latter uses the default implementation
+    other = SQLite3HubStorage(str(tmp_path / 'other.db'))
+    for storage in [hub_storage, redis_storage,
+                    SyncHubStorageAdapter(AsyncHubStorageAdapter(other))]:
+        storage.import_subscriptions([('topic', 'a', 'x', now + 60),
+                                      ('topic', 'b', 'y', now + 60)])
+        storage.merge_subscriptions(merged)
+        assert sorted(map(tuple, storage.get_callbacks('topic'))) == [
+            ('a', 'newer'), ('b', 'y'), ('c', 'added')
+        ]
+
+
+def test_async_hub_storage(tmp_path):
+    storage = AsyncSQLite3HubStorage(str(tmp_path / 'hub.db'), max_workers=2)
+
+    async def run():
+        value = {'lease_seconds': 60, 'secret': None}
+        await storage.set(('topic', 'a'), value)
+        await storage.set_many([(('topic', c), value) for c in 'bcd'])
+        await storage.delete(('topic', 'b'))
+        pages = [[tuple(row) for row in page]
+                 async for page in storage.get_callback_pages('topic', 2)]
+        assert pages == [[('a', None), ('c', None)], [('d', None)]]
+        exported = [s async for s in storage.export_subscriptions()]
+        assert len(exported) == 3
+        assert await storage.cleanup_expired_subscriptions() == 0
+    asyncio.run(run())
+
+
+def test_sync_hub_storage_adapter(tmp_path):
+    # the other way around
+    storage = SyncHubStorageAdapter(
+        AsyncSQLite3HubStorage(str(tmp_path / 'hub.db')))
+    subscribe(storage, 'topic', 'a')
+    subscribe(storage, 'topic', 'b', lease_seconds=-1)
+    assert callbacks(storage, 'topic') == [('a', None)]
+    assert [len(page) for page in storage.get_callback_pages('topic')] == [1]
+    del storage['topic', 'a']
+    assert callbacks(storage, 'topic') == []
+    assert storage.cleanup_expired_subscriptions() == 1
+
+
+@pytest.fixture(params=['filesystem', 'cache'])
+def body_store(request, tmp_path):
+    if request.param == 'filesystem':
+        return FileSystemBodyStore(str(tmp_path / 'bodies'))
+    return CacheBodyStore(SimpleCache(default_timeout=0))
+
+
+def test_body_store_refcount(body_store):
+    body_ref = body_store.add(b'Hello World!')
+    assert body_ref.startswith(body_digest(b'Hello World!'))
+    assert bytes(body_store[body_ref]) == b'Hello World!'
+
+    body_store.acquire(body_ref, references=2)
+    body_store.release(body_ref, references=2)
+    assert bytes(body_store[body_ref]) == b'Hello World!'
+
+    body_store.acquire(body_ref)
+    body_store.release(body_ref)
+    body_store.release(body_ref)
+    with pytest.raises(KeyError):
+        body_store[body_ref]
+
+
+def test_body_store_same_content(body_store):
+    # a second distribution of the same content, while the first one ends
+    first = body_store.add(b'Hello World!')
+    second = body_store.add(b'Hello World!')
+    body_store.release(first)
+    assert bytes(body_store[second]) == b'Hello World!'
+    body_store.release(second)
+    with pytest.raises(KeyError):
+        body_store[second]
+
+
+def test_file_system_body_store_deduplicates(tmp_path):
+    body_store = FileSystemBodyStore(str(tmp_path / 'bodies'))
+    digest = body_store.add(b'Hello World!')
+    assert digest == body_digest(b'Hello World!')
+    # adding the same body again only adds references
+    assert body_store.add(b'Hello World!', references=2) == digest
+    body_store.release(digest, references=2)
+    assert bytes(body_store[digest]) == b'Hello World!'
+
+
+def test_cache_body_store_expires():
+    cache = Mock(wraps=SimpleCache())
+    body_ref = CacheBodyStore(cache, timeout=60).add(b'Hello World!')
+    assert [(c[0][0], c[1]) for c in cache.set.call_args_list] == [
+        ('refs:' + body_ref, {'timeout': 60}),
+        ('body:' + body_ref, {'timeout': 60}),
+    ]
+
+
+def test_body_store_empty(body_store):
+    digest = body_store.add(b'')
+    assert bytes(body_store[digest]) == b''
@@ -0,0 +1,574 @@
+from cachelib import SimpleCache
+import pytest
+import requests
+
+import asyncio
+import base64
+import tempfile
+import time
+from unittest.mock import MagicMock, Mock, patch
+
+from flask_websub.hub import CircuitBreaker, HostRateLimiter, IntentBatcher, \
+                             AsyncDeliveryEngine, Hub
+from flask_websub.errors import NotificationError
+from flask_websub.hub.tasks import Signer, deliver, retry_countdown, \
+                                   start_distribution, superseded, \
+                                   make_request_retrying, make_batch_request, \
+                                   release_parked, subscribe, POSTPONED, \
+                                   send_change_notification, read_content, \
+                                   store_body, load_body, BodyVariants, \
+                                   encoded_chunks, laned_chunks, \
+                                   schedule_requests, verify_intents, \
+                                   interleave_by_host
+from flask_websub.utils import body_digest, calculate_hmac, decompress
+
+
+def test_signer():
+    body = b'Hello World!'
+    expected = 'sha512=' + calculate_hmac('sha512', 'abc', body)
+    with Signer({}, body) as signer:
+        assert signer(None) is None
+        assert signer('abc') == expected
+
+
+def test_signer_signs_once():
+    body = b'x' * 1024 * 1024
+    config = {'SIGNATURE_ALGORITHM': 'sha256', 'SIGNATURE_THREADS': 2}
+    with Signer(config, body) as signer:
+        with patch.object(signer, 'calculate',
+                          wraps=signer.calculate) as calculate:
+            signer.prepare(['a', 'b', None, 'a'])
+            assert [signer(s) for s in 'aab'] == [
+                'sha256=' + calculate_hmac('sha256', s, body) for s in 'aab'
+            ]
+            assert calculate.call_count == 2
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(SimpleCache(), threshold=2, reset_timeout=60,
+                             probe_interval=10)
+    assert breaker.allow('example.com')
+    breaker.record_failure('example.com')
+    breaker.record_success('example.com')
+    breaker.record_failure('example.com')
+    assert breaker.allow('example.com')
+    breaker.record_failure('example.com')
+    assert not breaker.allow('example.com')
+    assert 59 < breaker.retry_after('example.com') <= 60
+    assert breaker.allow('example.org')
+
+    # half-open: a single probe is allowed
+    breaker.cache.delete('breaker-open:example.com')
+    assert breaker.retry_after('example.com') == 0
+    assert breaker.allow('example.com')
+    assert not breaker.allow('example.com')
+    breaker.record_success('example.com')
+    assert breaker.allow('example.com')
+    assert breaker.allow('example.com')
+
+
+def test_deliver_circuit_breaker():
+    hub = Mock(config={'BACKOFF_BASE': 0.0}, rate_limiter=None)
+    hub.circuit_breaker = CircuitBreaker(SimpleCache(), threshold=1)
+    error = requests.exceptions.ConnectionError()
+    with patch('flask_websub.hub.tasks.request_url',
+               side_effect=error) as request_url:
+        assert deliver(hub, 'http://down/1', {}, b'') is None
+        assert deliver(hub, 'http://down/2', {}, b'') is POSTPONED
+        assert request_url.call_count == 1
+    assert retry_countdown(hub, 'http://down/3', 0) > 59
+    assert retry_countdown(hub, 'http://up/1', 0) == 0
+
+
+def test_engine_postponed():
+    hub = Mock(config={'MAX_ATTEMPTS': 0})
+    hub.circuit_breaker = CircuitBreaker(SimpleCache(), probe_interval=0.01)
+    engine = AsyncDeliveryEngine()
+    statuses = [POSTPONED, POSTPONED, 200]
+
+    async def deliver(*args):
+        return statuses.pop(0)
+
+    async def run():
+        slots = asyncio.Semaphore(1)
+        await slots.acquire()
+        with patch.object(engine, 'deliver', deliver):
+            await engine.deliver_retrying(hub, None, slots,
+                                          asyncio.Semaphore(1), 'topic',
+                                          'http://down/', {}, b'', None, {},
+                                          [])
+    asyncio.run(run())
+    # waiting for the host did not use up the (zero) retries
+    assert not statuses
+
+
+def test_circuit_breaker_parking():
+    breaker = CircuitBreaker(SimpleCache(default_timeout=0))
+    assert breaker.park('example.com', 1)
+    assert breaker.park('example.com', 2)
+    assert breaker.parked('example.com') == 2
+    assert breaker.unpark('example.com', 1) == [1]
+    assert breaker.park('example.com', 3)
+    assert breaker.unpark('example.com', 10) == [2, 3]
+    assert breaker.unpark('example.com', 10) == []
+    assert breaker.parked('example.com') == 0
+
+    # unpark claimed the slot before park stored the delivery in it
+    breaker.cache.set('breaker-unparked:example.com', 4)
+    assert not breaker.park('example.com', 4)
+    assert breaker.unpark('example.com', 10) == []
+
+
+def test_circuit_breaker_parks_many():
+    breaker = CircuitBreaker(SimpleCache(threshold=10 ** 9,
+                                         default_timeout=0))
+    for i in range(1000):
+        assert breaker.park('example.com', i)
+    assert breaker.parked('example.com') == 1000
+    assert breaker.unpark('example.com', 2000) == list(range(1000))
+
+
+def test_circuit_breaker_requires_cache():
+    with pytest.raises(ValueError):
+        Hub(None, CIRCUIT_BREAKER_THRESHOLD=5)
+    hub = Hub(None, cache=SimpleCache(), CIRCUIT_BREAKER_THRESHOLD=5)
+    assert hub.circuit_breaker.cache is hub.cache
+
+
+def breaker_hub():
+    hub = Mock(config={'BACKOFF_BASE': 0.0}, rate_limiter=None,
+               body_store=None)
+    hub.circuit_breaker = CircuitBreaker(SimpleCache(default_timeout=0),
+                                         threshold=1, probe_interval=10)
+    hub.circuit_breaker.record_failure('down')
+    return hub
+
+
+def retrying_task(retries):
+    return Mock(request=Mock(retries=retries), max_retries=10)
+
+
+def test_make_request_parked():
+    hub = breaker_hub()
+    breaker = hub.circuit_breaker
+    for i in range(2):
+        task = retrying_task(3)
+        with patch('flask_websub.hub.tasks.request_url') as request_url:
+            make_request_retrying(hub, task, 'topic', 'http://down/%s' % i,
+                                  {}, 'Ym9keQ==')
+        # held instead of retried, and not counted as an attempt
+        assert not request_url.called
+        assert not task.retry.called
+    assert breaker.parked('down') == 2
+    # a single task releases them
+    assert hub.release_parked.apply_async.call_count == 1
+    assert hub.release_parked.apply_async.call_args[0][0] == ('down',)
+
+
+def test_make_batch_request_parked():
+    hub = breaker_hub()
+    batch = [('http://down/%s' % i, None) for i in range(5)]
+    with patch('flask_websub.hub.tasks.request_url') as request_url:
+        make_batch_request(hub, 'topic', batch, {}, 'Ym9keQ==')
+    assert not request_url.called
+    assert not hub.make_request_retrying.apply_async.called
+    assert hub.circuit_breaker.parked('down') == 5
+
+
+def test_release_parked():
+    hub = breaker_hub()
+    breaker = hub.circuit_breaker
+    make_request_retrying(hub, retrying_task(3), 'topic', 'http://down/1',
+                          {}, 'Ym9keQ==')
+    make_request_retrying(hub, retrying_task(0), 'topic', 'http://down/2',
+                          {}, 'Ym9keQ==')
+    hub.release_parked.reset_mock()
+
+    # still open
+    release_parked(hub, 'down')
+    assert not hub.make_request_retrying.apply_async.called
+    assert hub.release_parked.apply_async.call_args[1]['countdown'] > 59
+
+    # half-open: a single one probes the host
+    breaker.cache.delete('breaker-open:down')
+    release_parked(hub, 'down')
+    calls = hub.make_request_retrying.apply_async.call_args_list
+    assert [c[0][0][1] for c in calls] == ['http://down/1']
+    assert calls[0][1]['retries'] == 3
+    assert hub.release_parked.apply_async.call_args[1]['countdown'] == 10
+
+    # closed: everything is sent, with the amount of retries it had
+    breaker.record_success('down')
+    release_parked(hub, 'down')
+    calls = hub.make_request_retrying.apply_async.call_args_list
+    assert [(c[0][0][1], c[1]['retries']) for c in calls] == [
+        ('http://down/1', 3), ('http://down/2', 0)
+    ]
+    assert hub.release_parked.apply_async.call_count == 2
+    assert breaker.parked('down') == 0
+    # the next host outage schedules a new release
+    assert breaker.claim_release('down')
+
+
+def test_superseded():
+    hub = Mock(config={'COALESCE_NOTIFICATIONS': True})
+    hub.shared_cache.return_value = SimpleCache()
+    first = start_distribution(hub, 'topic')
+    assert not superseded(hub, 'topic', first)
+    second = start_distribution(hub, 'topic')
+    assert superseded(hub, 'topic', first)
+    assert not superseded(hub, 'topic', second)
+    assert not superseded(hub, 'other', first)
+    assert not superseded(hub, 'topic', None)
+
+    hub.config = {}
+    assert start_distribution(hub, 'topic') is None
+
+
+def test_rate_limiter():
+    limiter = HostRateLimiter(SimpleCache(), rate=10.0, burst=2,
+                              max_rate=10.5)
+    assert limiter.acquire('example.com') == 0
+    assert limiter.acquire('example.com') == 0
+    assert 0 < limiter.acquire('example.com') <= 0.1
+    assert limiter.acquire('example.org') == 0
+
+    # additive increase, multiplicative decrease
+    limiter.record('example.com', 0.1, overloaded=False)
+    assert limiter.state('example.com', time.time())[1] == 10.1
+    for i in range(10):
+        limiter.record('example.com', 0.1, overloaded=False)
+    assert limiter.state('example.com', time.time())[1] == 10.5
+    limiter.record('example.com', 0.1, overloaded=True)
+    assert limiter.state('example.com', time.time())[1] == 5.25
+    limiter.record('example.com', 2.0, overloaded=False)  # slow
+    assert limiter.state('example.com', time.time())[1] == 2.625
+
+    assert limiter.wait('example.com', max_wait=1)
+    assert 0 < limiter.delay('example.com') < 1
+    assert not limiter.wait('example.com', max_wait=0)
+    assert limiter.overloaded(None)
+    assert limiter.overloaded(503)
+    assert not limiter.overloaded(404)
+
+
+CONTENT = {
+    'content': base64.b64encode(b'Hello World!').decode('ascii'),
+    'headers': {'Link': '<http://a/>; rel="self", <http://b/>; rel="hub"'},
+}
+
+
+def test_deduplicate_content():
+    hub = Mock(config={'DEDUPLICATE_CONTENT': True})
+    hub.shared_cache.return_value = SimpleCache()
+    with patch('flask_websub.hub.tasks.distribute') as distribute:
+        send_change_notification(hub, 'topic', CONTENT)
+        send_change_notification(hub, 'topic', CONTENT)
+        assert distribute.call_count == 1
+        send_change_notification(hub, 'other', CONTENT)
+        assert distribute.call_count == 2
+
+
+def test_debounce():
+    hub = Mock(config={'DEBOUNCE_SECONDS': 5})
+    hub.shared_cache.return_value = SimpleCache()
+    with patch('flask_websub.hub.tasks.distribute') as distribute:
+        send_change_notification(hub, 'topic', CONTENT)
+        send_change_notification(hub, 'topic', CONTENT)
+        assert not distribute.called
+        assert hub.send_change.apply_async.call_count == 2
+        (first, second) = [c[0][1]['debounce_token']
+                           for c in hub.send_change.apply_async.call_args_list]
+        assert hub.send_change.apply_async.call_args[1]['countdown'] == 5
+
+        # the first one is superseded by the second one
+        send_change_notification(hub, 'topic', CONTENT, first)
+        assert not distribute.called
+        send_change_notification(hub, 'topic', CONTENT, second)
+        assert distribute.called
+
+
+def test_debounce_late_task():
+    hub = Mock(config={'DEBOUNCE_SECONDS': 5})
+    hub.shared_cache.return_value = cache = SimpleCache()
+    with patch('flask_websub.hub.tasks.distribute') as distribute:
+        send_change_notification(hub, 'topic', CONTENT)
+        token = hub.send_change.apply_async.call_args[0][1]['debounce_token']
+        # the pending publish expired while the task was waiting
+        cache.delete('debounce:topic')
+        send_change_notification(hub, 'topic', CONTENT, token)
+        assert distribute.called
+
+
+def test_debounce_max_wait():
+    hub = Mock(config={'DEBOUNCE_SECONDS': 5, 'DEBOUNCE_MAX_WAIT': 20})
+    hub.shared_cache.return_value = cache = SimpleCache()
+    send_change_notification(hub, 'topic', CONTENT)
+    token, started = cache.get('debounce:topic')
+    assert hub.send_change.apply_async.call_args[1]['countdown'] == 5
+
+    # a burst of publishes, that started long ago
+    cache.set('debounce:topic', (token, started - 18))
+    send_change_notification(hub, 'topic', CONTENT)
+    assert 1 < hub.send_change.apply_async.call_args[1]['countdown'] <= 2
+    assert cache.get('debounce:topic')[1] == started - 18
+    cache.set('debounce:topic', (token, started - 30))
+    send_change_notification(hub, 'topic', CONTENT)
+    assert hub.send_change.apply_async.call_args[1]['countdown'] == 0
+
+
+def test_conditional_fetch():
+    hub = Mock(config={'CONDITIONAL_FETCH': True})
+    hub.shared_cache.return_value = SimpleCache()
+    response = MagicMock(status_code=200, headers={
+        'ETag': '"abc"',
+        'Link': CONTENT['headers']['Link'],
+    })
+    response.iter_content.return_value = [b'Hello World!']
+    with patch('flask_websub.hub.tasks.distribute') as distribute, \
+            patch('flask_websub.hub.tasks.get_content',
+                  return_value=response) as get_content:
+        send_change_notification(hub, 'topic')
+        assert distribute.call_count == 1
+        assert get_content.call_args[0][2] is None
+
+        response.status_code = 304
+        send_change_notification(hub, 'topic')
+        assert get_content.call_args[0][2] == {'If-None-Match': '"abc"'}
+        assert distribute.call_count == 1
+
+
+def streaming_response(chunks, headers=None):
+    response = Mock(headers=headers or {})
+    response.iter_content.return_value = chunks
+    return response
+
+
+def test_read_content():
+    response = streaming_response([b'Hello ', b'World!'])
+    body, digest = read_content({}, response)
+    assert body == b'Hello World!'
+    assert digest == body_digest(b'Hello World!')
+
+
+def test_read_content_spooled():
+    response = streaming_response([b'Hello ', b'World!'])
+    body, digest = read_content({'SPOOL_SIZE': 8}, response)
+    assert isinstance(body, memoryview)
+    assert body.tobytes() == b'Hello World!'
+    assert digest == body_digest(b'Hello World!')
+
+
+def test_read_content_too_large():
+    config = {'MAX_CONTENT_SIZE': 8}
+    response = streaming_response([b'Hello ', b'World!'])
+    with pytest.raises(NotificationError):
+        read_content(config, response)
+    response = streaming_response([], {'Content-Length': '12'})
+    with pytest.raises(NotificationError):
+        read_content(config, response)
+    assert not response.iter_content.called
+
+
+def test_read_content_too_large_spooled():
+    spools, create = [], tempfile.TemporaryFile
+
+    def temporary_file():
+        spools.append(create())
+        return spools[-1]
+
+    config = {'MAX_CONTENT_SIZE': 8, 'SPOOL_SIZE': 4}
+    response = streaming_response([b'Hello ', b'World!'])
+    with patch('tempfile.TemporaryFile', temporary_file), \
+            pytest.raises(NotificationError):
+        read_content(config, response)
+    spool, = spools
+    assert spool.closed
+
+
+def test_body_references():
+    hub = Mock(config={}, body_store=None)
+    body_ref = store_body(hub, b'Hello World!')
+    assert body_ref == base64.b64encode(b'Hello World!').decode('ascii')
+    assert load_body(hub, body_ref) == b'Hello World!'
+
+    hub.config['BODY_SERIALIZER'] = 'msgpack'
+    body_ref = store_body(hub, memoryview(b'Hello World!'))
+    assert body_ref == b'Hello World!'
+    assert load_body(hub, body_ref) == b'Hello World!'
+
+
+def test_encoded_chunks():
+    hub = Mock(config={'COMPRESSION': ['zstd', 'gzip']})
+    hub.shared_callback_cache.return_value = cache = SimpleCache()
+    cache.set('encodings:http://a', ['gzip'])
+    cache.set('encodings:http://b', ['gzip', 'zstd'])
+    chunks = [[('http://a', 'sig'), ('http://b', None), ('http://c', None)]]
+    assert list(encoded_chunks(hub, chunks, 2048)) == [[
+        ('http://a', 'sig', 'gzip'),
+        ('http://b', None, 'zstd'),
+        ('http://c', None, None),
+    ]]
+    # too small to be worth it
+    small_chunk, = encoded_chunks(hub, chunks, 10)
+    assert small_chunk[0] == ('http://a', 'sig', None)
+
+
+def test_unsupported_compression():
+    with patch('flask_websub.hub.supported_encodings',
+               return_value=['gzip']):
+        hub = Hub(None, COMPRESSION=['zstd', 'gzip'])
+    assert hub.config['COMPRESSION'] == ['gzip']
+
+
+def test_body_variants():
+    hub = Mock(config={}, body_store=None)
+    body = b'Hello World!' * 100
+    headers = {'Link': 'abc', 'content-encoding': 'gzip'}
+    variants = BodyVariants(hub, body, None, headers)
+    assert variants[None] == (body, {'Link': 'abc'})
+    compressed, gzip_headers = variants['gzip']
+    assert gzip_headers == {'Link': 'abc', 'Content-Encoding': 'gzip'}
+    assert decompress('gzip', compressed, len(body)) == body
+    # compressed only once
+    assert variants['gzip'][0] is compressed
+    body_ref, _ = variants.ref('gzip')
+    assert load_body(hub, body_ref) == compressed
+
+
+def test_laned_chunks():
+    hub = Mock(config={'LARGE_FANOUT_THRESHOLD': 3})
+    chunks = [[('a', None, None), ('b', None, None)],
+              [('c', None, None), ('d', None, 'gzip')]]
+    assert list(laned_chunks(hub, chunks)) == [
+        [('a', None, None, 'default'), ('b', None, None, 'default')],
+        [('c', None, None, 'default'), ('d', None, 'gzip', 'bulk')],
+    ]
+
+
+def test_schedule_requests_lanes():
+    hub = Mock(body_store=None, config={'DELIVERY_LANES': {
+        'bulk': {'queue': 'bulk', 'priority': 1},
+    }})
+    variants = BodyVariants(hub, b'Hello World!', None, {})
+    chunks = [[('http://a', None, None, 'default'),
+               ('http://b', None, None, 'bulk')]]
+    schedule_requests(hub, 'topic', chunks, variants, None)
+    calls = hub.make_request_retrying.apply_async.call_args_list
+    assert [c[1] for c in calls] == [{}, {'queue': 'bulk', 'priority': 1}]
+    assert [c[0][0][1] for c in calls] == ['http://a', 'http://b']
+
+
+def test_schedule_requests_batches():
+    hub = Mock(body_store=None, config={'BATCH_SIZE': 3})
+    variants = BodyVariants(hub, b'Hello World!', None, {})
+    # one callback per host is the common case
+    chunks = [[('http://%s/' % host, None, None, 'default')
+               for host in 'cabdb']]
+    schedule_requests(hub, 'topic', chunks, variants, None)
+    batches = [c[0][0][1] for c in
+               hub.make_batch_request.apply_async.call_args_list]
+    assert [[callback for callback, _ in batch] for batch in batches] == [
+        ['http://a/', 'http://b/', 'http://b/'],
+        ['http://c/', 'http://d/'],
+    ]
+
+
+def test_intent_batcher():
+    send = Mock()
+    batcher = IntentBatcher(send, batch_size=2, delay=0.01)
+    batcher.add(1)
+    batcher.add(2)
+    send.assert_called_once_with([1, 2])
+    batcher.add(3)
+    while send.call_count != 2:
+        time.sleep(0.01)
+    send.assert_called_with([3])
+
+
+def test_interleave_by_host():
+    intents = [['subscribe', 'http://a/%s' % i] for i in range(3)]
+    intents.append(['subscribe', 'http://b/'])
+    assert [i[1] for i in interleave_by_host(intents)] == [
+        'http://a/0', 'http://b/', 'http://a/1', 'http://a/2',
+    ]
+
+
+def test_verify_intents():
+    hub = Mock(config={}, validators=[])
+    intents = [
+        ['subscribe', 'http://a/1', 'topic', 60, 'secret', None],
+        ['subscribe', 'http://b/1', 'topic', 60, None, None],
+        ['unsubscribe', 'http://a/2', 'topic', 60, None, None],
+    ]
+    stored = []
+    hub.storage.set_many.side_effect = lambda items: stored.extend(items)
+
+    def intent_verified(hub, callback_url, *args):
+        return callback_url != 'http://b/1'
+
+    with patch('flask_websub.hub.tasks.intent_verified', intent_verified):
+        verify_intents(hub, intents)
+    assert stored == [(('topic', 'http://a/1'), {
+        'lease_seconds': 60,
+        'secret': 'secret',
+    })]
+    deleted, = hub.storage.delete_many.call_args[0]
+    assert list(deleted) == [('topic', 'http://a/2')]
+
+
+def rate_limited_hub():
+    hub = Mock(config={'BACKOFF_BASE': 0.0, 'REQUEST_TIMEOUT': 0},
+               circuit_breaker=None, body_store=None, validators=[],
+               storage=MagicMock())
+    hub.rate_limiter = HostRateLimiter(SimpleCache(), rate=0.1, burst=1)
+    hub.rate_limiter.acquire('limited')
+    return hub
+
+
+def test_make_request_rate_limited():
+    hub = rate_limited_hub()
+    task = retrying_task(3)
+    with patch('flask_websub.hub.tasks.request_url') as request_url:
+        make_request_retrying(hub, task, 'topic', 'http://limited/', {},
+                              'Ym9keQ==')
+    assert not request_url.called
+    # re-scheduled, but not counted as an attempt
+    assert not task.retry.called
+    kwargs = hub.make_request_retrying.apply_async.call_args[1]
+    assert kwargs['retries'] == 3
+    assert 9 < kwargs['countdown'] <= 10
+
+
+def test_subscribe_rate_limited():
+    hub = rate_limited_hub()
+    with patch('flask_websub.hub.tasks.request_url') as request_url:
+        subscribe(hub, 'http://limited/', 'topic', 60, None, None)
+    assert not request_url.called
+    assert not hub.storage.__setitem__.called
+    args, kwargs = hub.subscribe.apply_async.call_args
+    assert args[0] == ('http://limited/', 'topic', 60, None, None)
+    assert kwargs['countdown'] > 9
+
+
+def test_verify_intents_rate_limited():
+    hub = rate_limited_hub()
+    intents = [
+        ['subscribe', 'http://limited/', 'topic', 60, None, None],
+        ['subscribe', 'http://other/', 'topic', 60, None, None],
+        ['unsubscribe', 'http://limited/', 'topic', 60, None, None],
+    ]
+    response = Mock(status_code=200)
+
+    def request_url(config, method, url, params):
+        response.text = params['hub.challenge']
+        return response
+
+    with patch('flask_websub.hub.tasks.request_url', request_url):
+        verify_intents(hub, intents)
+    stored, = hub.storage.set_many.call_args[0]
+    assert [key for key, value in stored] == [('topic', 'http://other/')]
+    assert not hub.storage.delete_many.called
+    # both intents for the subscription are verified again later, in order
+    postponed, = hub.verify_intents.apply_async.call_args[0][0]
+    assert postponed == [intents[0], intents[2]]
@@ -8,18 +8,28 @@ import base64
 from unittest.mock import Mock, call
 
 from flask_websub.errors import SubscriberError, NotificationError
+from flask_websub.utils import body_digest
 from flask_websub.subscriber import Subscriber, SQLite3TempSubscriberStorage, \
                                     SQLite3SubscriberStorage, \
                                     WerkzeugCacheTempSubscriberStorage
-from flask_websub.hub import Hub, SQLite3HubStorage
+from flask_websub.hub import Hub, SQLite3HubStorage, FileSystemBodyStore, \
+                             AsyncDeliveryEngine
 from .utils import serve_app
 
 
-def run_hub_app(celery, worker, https):
+@pytest.fixture(scope='session')
+def celery_config():
+    return {'accept_content': ['json', 'pickle']}
+
+
+def run_hub_app(celery, worker, https, body_store=None, engine=None,
+                **config):
     app = Flask(__name__)
     app.config['PUBLISH_SUPPORTED'] = True
+    app.config.update(config)
 
-    hub = Hub(SQLite3HubStorage('hub.db'), celery, **app.config)
+    hub = Hub(SQLite3HubStorage('hub.db'), celery, body_store, engine,
+              **app.config)
     worker.reload()
 
     app.register_blueprint(hub.build_blueprint(url_prefix='/hub'))
@@ -35,7 +45,7 @@ def https_hub(celery_session_app, celery_session_worker):
     def new(*args, **kwargs):
         kwargs['verify'] = False
         return old(*args, **kwargs)
-    old, requests.request = requests.request, new
+    old, requests.Session.request = requests.Session.request, new
 
     # suppress warning
     import urllib3
@@ -45,7 +55,7 @@ def https_hub(celery_session_app, celery_session_worker):
                            https=True)
 
     # de-monkey patch
-    requests.request = old
+    requests.Session.request = old
 
 
 @pytest.fixture
@@ -54,6 +64,45 @@ def hub(celery_session_app, celery_session_worker):
                            https=False)
 
 
+@pytest.fixture
+def batch_hub(celery_session_app, celery_session_worker):
+    yield from run_hub_app(celery_session_app, celery_session_worker,
+                           https=False, BATCH_SIZE=2)
+
+
+@pytest.fixture
+def body_store_hub(celery_session_app, celery_session_worker, tmp_path):
+    body_store = FileSystemBodyStore(str(tmp_path / 'bodies'))
+    yield from run_hub_app(celery_session_app, celery_session_worker,
+                           https=False, body_store=body_store)
+
+
+@pytest.fixture
+def binary_hub(celery_session_app, celery_session_worker):
+    yield from run_hub_app(celery_session_app, celery_session_worker,
+                           https=False, BODY_SERIALIZER='pickle')
+
+
+@pytest.fixture
+def compression_hub(celery_session_app, celery_session_worker):
+    yield from run_hub_app(celery_session_app, celery_session_worker,
+                           https=False, COMPRESSION=['zstd', 'gzip'],
+                           COMPRESSION_MIN_SIZE=0)
+
+
+@pytest.fixture
+def verification_hub(celery_session_app, celery_session_worker):
+    yield from run_hub_app(celery_session_app, celery_session_worker,
+                           https=False, VERIFICATION_BATCH_SIZE=2,
+                           VERIFICATION_BATCH_DELAY=0.1)
+
+
+@pytest.fixture
+def engine_hub(celery_session_app, celery_session_worker):
+    yield from run_hub_app(celery_session_app, celery_session_worker,
+                           https=False, engine=AsyncDeliveryEngine())
+
+
 def subscriber_app(subscriber):
     app = Flask(__name__)
     app.register_blueprint(subscriber.build_blueprint(url_prefix='/callbacks'))
@@ -151,6 +200,73 @@ def test_sub_notify_unsub(https_hub, subscriber):
     on_success.assert_called_with(topic, id, 'unsubscribe')
 
 
+def notify_many(hub, subscriber, topic, body, amount=3):
+    on_success = Mock()
+    subscriber.add_success_handler(on_success)
+    ids = {subscriber.subscribe(topic_url=topic,
+                                hub_url='http://localhost:5001/hub')
+           for _ in range(amount)}
+    while on_success.call_count != amount:
+        pass
+
+    on_topic_change = Mock()
+    subscriber.add_listener(on_topic_change)
+    content = {
+        'content': base64.b64encode(body).decode('ascii'),
+        'headers': {
+            'Link': ', '.join([
+                '<%s>; rel="self"' % topic,
+                '<http://localhost:5001/hub>; rel="hub"',
+            ])
+        },
+    }
+    hub.send_change_notification.delay(topic, content).get()
+    while on_topic_change.call_count != amount:  # pragma: no cover
+        pass
+    on_topic_change.assert_has_calls([call(topic, id, body) for id in ids],
+                                     any_order=True)
+
+
+def test_batch_notify(batch_hub, subscriber):
+    notify_many(batch_hub, subscriber, 'http://example.com/batch',
+                b'Hello Batch!')
+
+
+def test_body_store_notify(body_store_hub, subscriber):
+    body = b'Hello Body Store!'
+    notify_many(body_store_hub, subscriber, 'http://example.com/store', body)
+    # every delivery finished, so the body should be gone
+    while True:
+        try:
+            body_store_hub.body_store[body_digest(body)]
+        except KeyError:
+            break
+
+
+def test_binary_notify(binary_hub, subscriber):
+    notify_many(binary_hub, subscriber, 'http://example.com/binary',
+                b'Hello \x00\xff Binary!')
+
+
+def test_compressed_notify(compression_hub, subscriber):
+    topic = 'http://example.com/compressed'
+    notify_many(compression_hub, subscriber, topic, b'Hello Compression!')
+    for callback_url, secret in compression_hub.storage.get_callbacks(topic):
+        encodings = compression_hub.shared_callback_cache().get(
+            'encodings:' + callback_url)
+        assert encodings == ['gzip', 'zstd']
+
+
+def test_batched_verification(verification_hub, subscriber):
+    notify_many(verification_hub, subscriber, 'http://example.com/verify',
+                b'Hello Verification!')
+
+
+def test_engine_notify(engine_hub, subscriber):
+    notify_many(engine_hub, subscriber, 'http://example.com/engine',
+                b'Hello Engine!')
+
+
 def test_validator(hub, subscriber):
     on_error = Mock()
     subscriber.add_error_handler(on_error)
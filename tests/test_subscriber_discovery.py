@@ -1,8 +1,10 @@
 from flask_websub.subscriber import discover
 from flask_websub.errors import DiscoveryError
+from flask_websub.utils import get_session
 from .utils import serve_app
 import pytest
 from flask import Flask, make_response
+from unittest.mock import MagicMock, patch
 
 # app
 HTML = '''
@@ -25,6 +27,12 @@ def flask_server():
         r.headers['Link'] = '</hub>; rel="hub", </resource>; rel="self"'
         return r
 
+    @app.route('/cookie')
+    def cookie():
+        r = basic()
+        r.set_cookie('session', 'secret')
+        return r
+
     @app.route('/blank')
     def blank():
         return ''
@@ -54,3 +62,17 @@ def test_tags():
         'hub_url': '/hub',
         'topic_url': '/resource'
     }
+
+
+def test_no_cookies_kept():
+    discover('http://localhost:5000/cookie')
+    assert not get_session({}).cookies
+
+
+def test_response_closed():
+    resp = MagicMock(links={'hub': {'url': '/hub'},
+                            'self': {'url': '/resource'}})
+    with patch('flask_websub.subscriber.discovery.get_content',
+               return_value=resp):
+        discover('http://localhost:5000/basic')
+    resp.__exit__.assert_called_once()
@@ -0,0 +1,135 @@
+from flask import Flask, current_app
+
+import sqlite3
+import threading
+import time
+from unittest.mock import Mock, patch
+
+from flask_websub.subscriber import Subscriber, MemoryNotificationQueue, \
+                                    SQLite3NotificationQueue, \
+                                    NotificationDispatcher
+
+
+def test_memory_queue_full():
+    queue = MemoryNotificationQueue(max_size=1)
+    assert queue.put(('topic', 'id', b'body'))
+    assert not queue.put(('topic', 'id', b'body'))
+    assert len(queue) == 1
+    token, notification = queue.get(timeout=0)
+    assert notification == ('topic', 'id', b'body')
+    assert queue.get(timeout=0) is None
+
+
+def test_sqlite_queue(tmp_path):
+    queue = SQLite3NotificationQueue(str(tmp_path / 'queue.db'), max_size=2)
+    assert queue.put(('topic', 'a', b'1'))
+    assert queue.put(('topic', 'b', b'2'))
+    assert not queue.put(('topic', 'c', b'3'))
+    token, notification = queue.get(timeout=0)
+    assert notification == ('topic', 'a', b'1')
+    # in progress notifications still count
+    assert len(queue) == 2
+    queue.ack(token)
+    assert len(queue) == 1
+    assert queue.get(timeout=0)[1] == ('topic', 'b', b'2')
+    assert queue.get(timeout=0) is None
+
+
+def test_sqlite_queue_redelivery(tmp_path):
+    queue = SQLite3NotificationQueue(str(tmp_path / 'queue.db'),
+                                     visibility_timeout=0, max_attempts=2)
+    queue.put(('topic', 'a', b'1'))
+    first, notification = queue.get(timeout=0)
+    second, again = queue.get(timeout=0)
+    assert first == second
+    assert notification == again
+    # attempts exhausted
+    assert queue.get(timeout=0) is None
+    assert len(queue) == 0
+
+
+def test_sqlite_queue_wakes_up(tmp_path):
+    queue = SQLite3NotificationQueue(str(tmp_path / 'queue.db'),
+                                     poll_interval=10)
+    threading.Timer(0.1, queue.put, [('topic', 'a', b'1')]).start()
+    start = time.monotonic()
+    assert queue.get(timeout=5)[1] == ('topic', 'a', b'1')
+    assert time.monotonic() - start < 5
+
+
+def test_dispatcher(tmp_path):
+    app = Flask(__name__)
+    queue = SQLite3NotificationQueue(str(tmp_path / 'queue.db'),
+                                     visibility_timeout=0.5,
+                                     poll_interval=0.1)
+    dispatcher = NotificationDispatcher(queue, workers=2)
+    handled = []
+    done = threading.Event()
+
+    def handle(topic_url, callback_id, body):
+        assert current_app._get_current_object() is app
+        if body == b'fail' and b'fail' not in handled:
+            handled.append(body)
+            raise ValueError('temporary failure')
+        handled.append(body)
+        if len(handled) == 3:
+            done.set()
+
+    assert dispatcher.dispatch('topic', 'id', b'ok')
+    assert dispatcher.dispatch('topic', 'id', memoryview(b'fail'))
+    dispatcher.start(app, handle)
+    assert done.wait(5)
+    assert sorted(handled) == [b'fail', b'fail', b'ok']
+    # allow the last ack to finish
+    for _ in range(50):
+        if dispatcher.stats()['processed'] == 2:
+            break
+        time.sleep(0.1)
+    assert dispatcher.stats() == {'depth': 0, 'accepted': 2, 'refused': 0,
+                                  'processed': 2, 'failed': 1}
+
+
+def test_dispatcher_survives_queue_errors():
+    results = [sqlite3.OperationalError('locked'),
+               ('a', ('topic', 'id', b'1')), ('b', ('topic', 'id', b'2'))]
+
+    def get(timeout):
+        if not results:
+            time.sleep(timeout)
+            return None
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    queue = Mock(get=get, ack=Mock(side_effect=[
+        sqlite3.OperationalError('locked'), None]))
+    dispatcher = NotificationDispatcher(queue, workers=1)
+    handled = []
+    done = threading.Event()
+
+    def handle(topic_url, callback_id, body):
+        handled.append(body)
+        if len(handled) == 2:
+            done.set()
+
+    with patch('flask_websub.subscriber.dispatch.QUEUE_ERROR_DELAY', 0):
+        dispatcher.start(Flask(__name__), handle)
+        assert done.wait(5)
+    assert handled == [b'1', b'2']
+    assert dispatcher.threads[0].is_alive()
+
+
+def test_dispatcher_drains_queue_on_start(tmp_path):
+    # left behind by an earlier process
+    path = str(tmp_path / 'queue.db')
+    SQLite3NotificationQueue(path).put(('topic', 'id', b'left behind'))
+
+    queue = SQLite3NotificationQueue(path, poll_interval=0.1)
+    subscriber = Subscriber(Mock(), Mock(), NotificationDispatcher(queue))
+    handled = threading.Event()
+    subscriber.add_listener(lambda *args: handled.set())
+    app = Flask(__name__)
+    app.register_blueprint(subscriber.build_blueprint())
+    # without any new notification coming in
+    assert handled.wait(5)
@@ -0,0 +1,109 @@
+from cachelib import SimpleCache
+import pytest
+
+import asyncio
+from unittest.mock import patch
+
+from flask_websub.subscriber import SQLite3SubscriberStorage, \
+                                    CachedSubscriberStorage, \
+                                    AsyncSQLite3SubscriberStorage, \
+                                    AsyncSQLite3TempSubscriberStorage, \
+                                    SyncSubscriberStorageAdapter, \
+                                    SyncTempSubscriberStorageAdapter
+
+SUBSCRIPTION = {
+    'mode': 'subscribe',
+    'topic_url': 'http://example.com/topic',
+    'hub_url': 'http://example.com/hub',
+    'secret': None,
+    'lease_seconds': 60,
+}
+
+
+def test_async_subscriber_storage(tmp_path):
+    storage = AsyncSQLite3SubscriberStorage(str(tmp_path / 'sub.db'))
+    temp_storage = AsyncSQLite3TempSubscriberStorage(str(tmp_path / 'tmp.db'))
+
+    async def run():
+        await temp_storage.set('id', dict(SUBSCRIPTION, timeout=60))
+        request = await temp_storage.pop('id')
+        with pytest.raises(KeyError):
+            await temp_storage.pop('id')
+        await storage.set('id', request)
+        assert await storage.get('id') == SUBSCRIPTION
+        expiring = [s async for s in storage.close_to_expiration(120)]
+        assert [s['callback_id'] for s in expiring] == ['id']
+        await storage.delete('id')
+        with pytest.raises(KeyError):
+            await storage.get('id')
+    asyncio.run(run())
+
+
+def test_sync_subscriber_storage_adapter(tmp_path):
+    storage = SyncSubscriberStorageAdapter(
+        AsyncSQLite3SubscriberStorage(str(tmp_path / 'sub.db')))
+    temp_storage = SyncTempSubscriberStorageAdapter(
+        AsyncSQLite3TempSubscriberStorage(str(tmp_path / 'tmp.db')))
+    temp_storage['id'] = dict(SUBSCRIPTION, timeout=60)
+    storage['id'] = temp_storage.pop('id')
+    assert storage['id'] == SUBSCRIPTION
+    assert [s['callback_id'] for s in storage.close_to_expiration(120)] == \
+        ['id']
+    assert storage.pop('id') == SUBSCRIPTION
+    with pytest.raises(KeyError):
+        storage['id']
+
+
+def test_cached_subscriber_storage(tmp_path):
+    backend = SQLite3SubscriberStorage(str(tmp_path / 'sub.db'))
+    versions = SimpleCache()
+    storage = CachedSubscriberStorage(backend, versions)
+    other_process = CachedSubscriberStorage(backend, versions)
+    storage['id'] = SUBSCRIPTION
+    assert storage['id'] == SUBSCRIPTION
+    assert other_process['id'] == SUBSCRIPTION
+
+    # served from memory
+    backend.pop('id')
+    assert storage['id'] == SUBSCRIPTION
+    # until invalidated
+    storage['id'] = dict(SUBSCRIPTION, secret='abc')
+    assert storage['id']['secret'] == 'abc'
+    assert other_process['id']['secret'] == 'abc'
+    del storage['id']
+    with pytest.raises(KeyError):
+        other_process['id']
+
+
+def test_cached_subscriber_storage_race(tmp_path):
+    backend = SQLite3SubscriberStorage(str(tmp_path / 'sub.db'))
+    storage = CachedSubscriberStorage(backend)
+    storage['id'] = SUBSCRIPTION
+    get = backend.get_with_expiration_time
+
+    def racing_get(callback_id):
+        result = get(callback_id)
+        # a write finishes while the old subscription is being read
+        storage[callback_id] = dict(SUBSCRIPTION, secret='abc')
+        return result
+
+    with patch.object(backend, 'get_with_expiration_time', racing_get):
+        assert storage['id'] == SUBSCRIPTION
+    # the outdated subscription was not cached
+    assert storage['id']['secret'] == 'abc'
+
+
+def test_cached_subscriber_storage_expiration(tmp_path):
+    backend = SQLite3SubscriberStorage(str(tmp_path / 'sub.db'))
+    storage = CachedSubscriberStorage(backend, max_size=1)
+    storage['expired'] = dict(SUBSCRIPTION, lease_seconds=-1)
+    with pytest.raises(KeyError):
+        storage['expired']
+    storage['id'] = SUBSCRIPTION
+    subscription, expiration_time = storage.get_with_expiration_time('id')
+    assert subscription == SUBSCRIPTION
+    entry = storage.subscriptions.entries['id']
+    assert entry[1] <= expiration_time  # never used after expiring
+    storage['id2'] = SUBSCRIPTION
+    storage['id2']
+    assert list(storage.subscriptions.entries) == ['id2']
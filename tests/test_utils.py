@@ -0,0 +1,56 @@
+import pytest
+
+from flask_websub import utils
+
+
+def test_session_shared():
+    session = utils.get_session({})
+    assert utils.get_session({'REQUEST_TIMEOUT': 5}) is session
+    assert utils.get_session({'POOL_MAXSIZE': 50}) is not session
+
+
+def test_session_pool_size():
+    session = utils.get_session({'POOL_MAXSIZE': 42})
+    assert session.get_adapter('https://example.com')._pool_maxsize == 42
+
+
+def test_session_reset():
+    session = utils.get_session({})
+    utils.reset_sessions()
+    assert utils.get_session({}) is not session
+
+
+def test_local_cache():
+    cache = utils.LocalCache(max_size=2)
+    assert cache.get('a', lambda: (1, None)) == 1
+    assert cache.get('a', lambda: (2, None)) == 1
+    # never used after expiring
+    assert cache.get('b', lambda: (3, 0)) == 3
+    assert cache.get('b', lambda: (4, None)) == 4
+    cache.invalidate('a')
+    assert cache.get('a', lambda: (5, None)) == 5
+
+    def fail():
+        raise KeyError('c')
+    with pytest.raises(KeyError):
+        cache.get('c', fail)
+    assert not cache.fetching
+    assert list(cache.entries) == ['b', 'a']
+
+
+@pytest.mark.parametrize('encoding', utils.supported_encodings())
+def test_compression(encoding):
+    body = b'Hello World!' * 100
+    compressed = utils.compress(encoding, body)
+    assert len(compressed) < len(body)
+    assert utils.decompress(encoding, compressed, len(body)) == body
+    with pytest.raises(ValueError):
+        utils.decompress(encoding, compressed, len(body) - 1)
+    with pytest.raises(ValueError):
+        utils.decompress(encoding, compressed[:-4], len(body))
+
+
+def test_parse_accept_encoding():
+    header = 'gzip;q=0.5, ZSTD, br;q=0, identity; q=1.0'
+    assert utils.parse_accept_encoding(header) == {'gzip', 'zstd', 'identity'}
+    assert utils.parse_accept_encoding(None) == set()
@@ -37,3 +37,127 @@ def serve_app(app, port, https=False):
         # tear down the server
         s.shutdown()
     t.join()
+
+
+class FakeRedis:
+    """An in-process stand-in for the subset of redis.Redis used by
+    RedisHubStorage. Like a real client, it returns bytes.
+
+    """
+    def __init__(self):
+        self.data = {}
+        self.versions = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def changed(self, key):
+        self.versions[key] = self.versions.get(key, 0) + 1
+        if not self.data.get(key, True):
+            del self.data[key]  # like redis, drop empty collections
+
+    def zadd(self, key, mapping):
+        self.data.setdefault(key, {}).update(mapping)
+        self.changed(key)
+
+    def zrem(self, key, *members):
+        zset = self.data.get(key, {})
+        for member in members:
+            zset.pop(decode(member), None)
+        self.changed(key)
+
+    def zmscore(self, key, members):
+        zset = self.data.get(key, {})
+        return [zset.get(decode(member)) for member in members]
+
+    def zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def zrangebyscore(self, key, min, max, start=None, num=None,
+                      withscores=False):
+        def bound(value):
+            value = str(value)
+            if value.startswith('('):
+                return float(value[1:]), True
+            return float(value), False
+        (low, low_open), (high, high_open) = bound(min), bound(max)
+        items = sorted(((score, member) for member, score
+                        in self.data.get(key, {}).items()))
+        items = [(score, member) for score, member in items
+                 if (low < score if low_open else low <= score) and
+                 (score < high if high_open else score <= high)]
+        if start is not None:
+            items = items[start:start + num]
+        if withscores:
+            return [(member.encode(), score) for score, member in items]
+        return [member.encode() for score, member in items]
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = value
+        self.changed(key)
+
+    def hdel(self, key, *fields):
+        hash = self.data.get(key, {})
+        for field in fields:
+            hash.pop(decode(field), None)
+        self.changed(key)
+
+    def hmget(self, key, fields):
+        hash = self.data.get(key, {})
+        return [hash[field].encode() if field in hash else None
+                for field in fields]
+
+    def sadd(self, key, member):
+        self.data.setdefault(key, set()).add(member)
+        self.changed(key)
+
+    def srem(self, key, member):
+        self.data.get(key, set()).discard(member)
+        self.changed(key)
+
+    def sscan_iter(self, key):
+        return [member.encode() for member in list(self.data.get(key, ()))]
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.watched = {}
+        self.queue = None  # commands are run immediately while watching
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.watched = {}
+
+    def watch(self, *keys):
+        for key in keys:
+            self.watched[key] = self.redis.versions.get(key, 0)
+
+    def multi(self):
+        self.queue = []
+
+    def execute(self):
+        import redis
+        for key, version in self.watched.items():
+            if self.redis.versions.get(key, 0) != version:
+                raise redis.WatchError()
+        results = [command() for command in self.queue or []]
+        self.queue = None
+        return results
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        if not self.watched and self.queue is None:
+            self.queue = []
+
+        def command(*args, **kwargs):
+            if self.queue is None:
+                return method(*args, **kwargs)
+            self.queue.append(lambda: method(*args, **kwargs))
+        return command
+
+
+def decode(value):
+    return value.decode() if isinstance(value, bytes) else value